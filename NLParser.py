@@ -14,21 +14,99 @@
 
 import re
 from datetime import datetime, timedelta
-import dateparser
 import os
 from typing import Tuple
 from typing_extensions import deprecated
 from dotenv import load_dotenv
 from abc import ABC, abstractmethod
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
-import torch
+import copy
 import json
+import threading
 
+import event_model
+import metrics
+import recurrence
+from parse_cache import ParseCache
+from parse_validation import ComputeBudget, validate, vote
 
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
-load_dotenv("./setup.env")
+
+# transformers / torch はモデル読み込み時まで import しない（UIの起動を速くするため）
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+load_dotenv(os.path.join(BASE_DIR, "setup.env"))
 MODEL_PATH = os.getenv("MODEL_PATH")
-assert MODEL_PATH != None
+
+# プロンプトを変更した場合はキャッシュを無効化するために更新すること
+PROMPT_VERSION = 3
+
+
+
+def _json_object_end(text: str):
+    """最初の "{" に対応する "}" の直後の位置を返す（まだ閉じていなければ None）"""
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def _json_stopping_criteria(tokenizer, prompt_len: int):
+    """生成部分のJSONオブジェクトが閉じた時点で生成を打ち切る StoppingCriteria"""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class JsonObjectComplete(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            done = [_json_object_end(tokenizer.decode(row[prompt_len:], skip_special_tokens=True)) is not None
+                    for row in input_ids]
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([JsonObjectComplete()])
+
+
+
+class ParseStream:
+    """
+    Streaming parse result
+
+    Iterating yields the generated text chunks as they are produced;
+    `result()` drains the remaining chunks and returns the parsed dict (or raises `ValueError`).
+    """
+    def __init__(self, chunks, finalize):
+        self._chunks = iter(chunks)
+        self._finalize = finalize
+        self._text = []
+        self._done = False
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self._text.append(chunk)
+            yield chunk
+        self._done = True
+
+    def result(self):
+        if not self._done:
+            for _ in self:
+                pass
+        return self._finalize("".join(self._text))
 
 
 
@@ -51,55 +129,389 @@ class BaseParser(ABC):
 class LLMEventParser(BaseParser):
     """
     Natural languages parser with LLM
+
+    Results are checked by `parse_validation.validate`. When the confidence is below `retry_threshold`
+    the input is parsed again within a per-request budget (`retry_tokens` generated tokens, `retry_seconds`):
+    first with greedy decoding, then by voting over `vote_samples` samples generated as one batch.
     """
-    def __init__(self, reference_time=None, model_path=MODEL_PATH, device=None, **kwargs):
-        super().__init__(reference_time=reference_time, **kwargs)
+    # 1回の生成で作るトークン数の上限
+    max_new_tokens = 128
+
+    def __init__(self, reference_time=None, model_path=MODEL_PATH, device=None, cache: ParseCache = None,
+                 prefix_cache: bool = True, constrained: bool = False, backend=None,
+                 retry_threshold: float = 0.7, retry_tokens: int = 640, retry_seconds: float = 10.0,
+                 vote_samples: int = 4, **kwargs):
+        super().__init__(reference_time=reference_time or event_model.now(), **kwargs)
         
-        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        from inference_backends import get_backend
+
+        if model_path is None:
+            raise ValueError("MODEL_PATH が設定されていません（setup.env を確認してください）")
+        if not os.path.isabs(model_path):
+            model_path = os.path.join(BASE_DIR, model_path)
+
+        self.model_path = model_path
+        self.cache = cache
+        self.prefix_cache = prefix_cache
+        self._prefix = None
+        self._prefix_lock = threading.Lock()
+        # スキーマ制約付きデコーディング（常に解析可能なJSONを出力する）
+        self.constrained = constrained
+        self._schema_decoder = None
+        # 確信度の低い結果の再試行（retry_threshold = 0 で無効化）
+        self.retry_threshold = retry_threshold
+        self.retry_tokens = retry_tokens
+        self.retry_seconds = retry_seconds
+        self.vote_samples = vote_samples
 
-        self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(model_path, 
-                                                          trust_remote_code=True,
-                                                          device_map = "auto" if self.device else {"":"cpu"},
-                                                          quantization_config=BitsAndBytesConfig(
-                                                            load_in_4bit=True,  # ここで指定
-                                                            bnb_4bit_quant_type="nf4",
-                                                            bnb_4bit_use_double_quant=True,
-                                                            bnb_4bit_compute_dtype=torch.float16  # または bfloat16
-                                                        )).to(self.device)
+        # 推論エンジン（setup.env の INFERENCE_BACKEND、省略時はGPUの有無で選択）
+        self.backend = backend or get_backend(device=device)
+        self.tokenizer, self.model = self.backend.load(model_path)
+        self.device = self.model.device
 
 
     def parse(self, text: str):
+        result, _ = self.parse_with_confidence(text)
+        return result
+
+
+    def parse_with_confidence(self, text: str):
+        """解析結果の辞書と確信度（0.0～1.0）を返す（確信度が低ければ `_retry` で解析し直した結果）"""
+        watch = metrics.stopwatch("llm_parse_phase_seconds")
+        key = self._cache_key(text)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached, validate(cached, self.reference_time)[0]
+        watch.lap("cache_lookup")
+
         prompt = self._build_prompt(text)
+        watch.lap("prompt_build")
         
         model_inputs = self.tokenizer([prompt], return_tensors="pt").to(self.model.device)
+        watch.lap("tokenize")
+
+        if self.constrained:
+            output_text = self._constrained_generate(model_inputs)
+            watch.lap("generate")
+        else:
+            generated_ids = self._generate(model_inputs)
+            watch.lap("generate")
+
+            output_ids = generated_ids[0][len(model_inputs.input_ids[0]):].tolist()
+            metrics.inc("tokens_generated_total", len(output_ids), mode="model")
+            output_text = self.tokenizer.decode(output_ids, skip_special_tokens=True).strip()
+            watch.lap("decode")
+
+        try:
+            parsed, error = self._parse_output_text(output_text), None
+        except ValueError as e:
+            parsed, error = None, e
+        watch.lap("json_parse")
+        parsed, confidence = self._retry(text, parsed, error)
+        watch.lap("retry")
+        if key is not None:
+            self.cache.put(key, parsed)
+        return parsed, confidence
+
+
+    def parse_many(self, texts, batch_size: int = 8):
+        """
+        複数の入力をバッチ単位でまとめて解析する
+
+        入力は長さ順に並べ替えてからバッチ化し（パディング削減のため）、
+        結果は入力と同じ順序のリストで返す。
+        解析に失敗した要素には、例外を送出する代わりに ValueError のインスタンスが入る。
+        """
+        texts = list(texts)
+        results = [None] * len(texts)
+
+        if self.constrained:
+            # 制約付きデコーディングは1系列ずつ行う
+            for i, text in enumerate(texts):
+                try:
+                    results[i] = self.parse(text)
+                except ValueError as e:
+                    results[i] = e
+            return results
+
+        # キャッシュ済みの入力は生成対象から外す
+        keys = [self._cache_key(t) for t in texts]
+        pending = []
+        for i, key in enumerate(keys):
+            cached = self.cache.get(key) if key is not None else None
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+        if not pending:
+            return results
+
+        prompts = {i: self._build_prompt(texts[i]) for i in pending}
+        order = sorted(pending, key=lambda i: len(prompts[i]))
+
+        for b in range(0, len(order), batch_size):
+            indices = order[b:b + batch_size]
+            model_inputs = self._batch_inputs([prompts[i] for i in indices])
+            try:
+                with metrics.timer("llm_batch_generate_seconds"):
+                    generated_ids = self._generate(model_inputs)
+            except Exception as e:
+                metrics.inc("parse_failures_total", len(indices), parser="llm", reason="generate")
+                for i in indices:
+                    results[i] = ValueError(f"LLMの生成に失敗しました: {e}")
+                continue
+
+            input_len = model_inputs.input_ids.shape[1]
+            for row, i in enumerate(indices):
+                output_ids = generated_ids[row][input_len:]
+                metrics.inc("tokens_generated_total", int((output_ids != self.tokenizer.pad_token_id).sum()), mode="model")
+                try:
+                    parsed, error = self._decode_output(output_ids.tolist()), None
+                except ValueError as e:
+                    parsed, error = None, e
+                # 確信度の低い要素だけを1件ずつ解析し直す
+                try:
+                    results[i], _ = self._retry(texts[i], parsed, error)
+                except ValueError as e:
+                    results[i] = e
+                    continue
+                if keys[i] is not None:
+                    self.cache.put(keys[i], results[i])
+
+        return results
+
+
+    def parse_stream(self, text: str) -> ParseStream:
+        """
+        生成されたテキストを逐次返しながら解析する
+
+        JSONオブジェクトが閉じた時点で生成を打ち切る。結果は `ParseStream.result()` で取得する
+        """
+        key = self._cache_key(text)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return ParseStream((), lambda _: cached)
+        if self.constrained:
+            return ParseStream((), lambda _: self.parse(text))
+
+        from transformers import TextIteratorStreamer
+
+        model_inputs = self.tokenizer([self._build_prompt(text)], return_tensors="pt").to(self.model.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+
+        def generate():
+            try:
+                self._generate(model_inputs, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+
+        def finalize(output_text):
+            thread.join()
+            if errors:
+                raise ValueError(f"LLMの生成に失敗しました: {errors[0]}")
+            try:
+                parsed, error = self._parse_output_text(output_text.strip()), None
+            except ValueError as e:
+                parsed, error = None, e
+            parsed, _ = self._retry(text, parsed, error)
+            if key is not None:
+                self.cache.put(key, parsed)
+            return parsed
+
+        return ParseStream(streamer, finalize)
+
 
-        generated_ids = self.model.generate(
-            **model_inputs,
-            max_new_tokens=128,  # 必要に応じて調整
+    def _cache_key(self, text: str):
+        if self.cache is None:
+            return None
+        return ParseCache.make_key(text, self.reference_time.date(), self.model_path, PROMPT_VERSION)
+
+
+    def warmup(self):
+        """
+        短い生成を一度だけ実行する
+
+        初回の生成で発生するカーネルの初期化などのコストを、実際のリクエストより前に払っておく
+        """
+        model_inputs = self.tokenizer([self._build_prompt("明日10時から会議")], return_tensors="pt").to(self.model.device)
+        self._generate(model_inputs, max_new_tokens=4)
+
+
+    def _generate(self, model_inputs, **overrides):
+        # 1系列の生成では、固定プレフィックスのKVキャッシュを再利用して可変部分だけをprefillする
+        # （左パディングされるバッチ生成ではプレフィックスの位置が揃わないので使わない）
+        batch_size = model_inputs["input_ids"].shape[0]
+        if "past_key_values" not in overrides and batch_size == 1:
+            _, prefix_kv = self._reusable_prefix(model_inputs["input_ids"][0])
+            if prefix_kv is not None:
+                overrides["past_key_values"] = prefix_kv
+
+        options = dict(
+            max_new_tokens=self.max_new_tokens,
             do_sample=True,
             temperature=0.1,
             top_p=0.99,
-            top_k=10
+            top_k=10,
+            pad_token_id=self.tokenizer.pad_token_id,
+            # JSONが閉じたら残りのトークンは生成しない
+            stopping_criteria=_json_stopping_criteria(self.tokenizer, model_inputs["input_ids"].shape[1])
         )
+        options.update(self.backend.generate_kwargs(batch_size))
+        options.update(overrides)
+        return self.model.generate(**model_inputs, **options)
+
+
+    def _batch_inputs(self, prompts):
+        # decoder-onlyモデルのバッチ生成は左パディングが必要
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        return self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+
 
-        output_ids = generated_ids[0][len(model_inputs.input_ids[0]):].tolist()
+    def _retry(self, text: str, parsed, error=None):
+        """
+        parsed（解析に失敗していれば None と error）の確信度が retry_threshold 未満なら解析し直す
+
+        計算量の上限内で、貪欲法による1回の生成 → 複数サンプルの多数決の順に試し、
+        確信度が retry_threshold に届いた時点で打ち切る。(解析結果, 確信度) を返し、
+        どの試行でも解析できなければ最初の ValueError を送出する
+        """
+        confidence, problems = validate(parsed, self.reference_time) if parsed is not None else (0.0, ["json"])
+        if confidence >= self.retry_threshold:
+            return parsed, confidence
+        for problem in problems:
+            metrics.inc("parse_low_confidence_total", problem=problem)
+
+        budget = ComputeBudget(self.retry_tokens, self.retry_seconds)
+        candidates = [(parsed, confidence)]
+        prompt = self._build_prompt(text)
+
+        # 制約付きデコーディングの初回はすでに貪欲法なので飛ばす
+        if not self.constrained and budget.allows(self.max_new_tokens):
+            metrics.inc("parse_retries_total", stage="greedy")
+            candidates += self._sample(self.tokenizer([prompt], return_tensors="pt").to(self.model.device), budget,
+                                       do_sample=False, temperature=None, top_p=None, top_k=None)
+            if candidates[-1][1] >= self.retry_threshold:
+                return candidates[-1]
+
+        n = min(self.vote_samples, budget.remaining_tokens() // self.max_new_tokens)
+        if n >= 2 and budget.allows(n * self.max_new_tokens):
+            metrics.inc("parse_retries_total", stage="vote")
+            candidates += self._sample(self._batch_inputs([prompt] * n), budget, temperature=0.7)
+
+        result, confidence = vote(candidates)
+        if result is None:
+            metrics.inc("parse_failures_total", parser="llm", reason="validation")
+            raise error or ValueError(f"LLM出力が予定として妥当ではありません: {problems}\n解析結果:\n{parsed}")
+        return result, confidence
+
+
+    def _sample(self, model_inputs, budget: ComputeBudget, **overrides):
+        """model_inputs の各行を生成して [(解析結果または None, 確信度)] を返す（使ったトークンは budget に計上する）"""
+        try:
+            generated_ids = self._generate(model_inputs, max_time=budget.remaining_seconds(), **overrides)
+        except Exception:
+            return []
+        input_len = model_inputs["input_ids"].shape[1]
+        candidates = []
+        for row in generated_ids:
+            output_ids = row[input_len:]
+            tokens = int((output_ids != self.tokenizer.pad_token_id).sum())
+            budget.spend(tokens)
+            metrics.inc("tokens_generated_total", tokens, mode="retry")
+            try:
+                parsed = self._decode_output(output_ids.tolist())
+            except ValueError:
+                candidates.append((None, 0.0))
+                continue
+            candidates.append((parsed, validate(parsed, self.reference_time)[0]))
+        return candidates
+
+
+    def _decode_output(self, output_ids):
         output_text = self.tokenizer.decode(output_ids, skip_special_tokens=True).strip()
+        return self._parse_output_text(output_text)
+
 
+    def _parse_output_text(self, output_text: str):
         try:
             parsed = json.loads(output_text)
             return parsed
+        except Exception:
+            pass
+
+        # 前後に余計なテキストがある場合はJSON部分だけを取り出して再解析する
+        try:
+            parsed = json.loads(self._extract_json_like(output_text))
+            metrics.inc("json_recovered_total")
+            return parsed
         except Exception as e:
+            metrics.inc("parse_failures_total", parser="llm", reason="json")
             raise ValueError(f"LLM出力の解析に失敗しました: {e}\n生成結果:\n{output_text}")
         
 
-    def _build_prompt(self, user_input: str):
-        prompt = f"""以下の文章は、予定に関する自然言語の記述です。
-今日の日付は {self.reference_time.strftime("%Y年%m月%d日")} です。文章に「明日」「明後日」などの表現がある場合は、これを基準に日時を解釈してください。
+    def _constrained_generate(self, model_inputs) -> str:
+        from constrained_decoding import EventSchemaDecoder
 
-文章: 「{user_input}」
+        if self._schema_decoder is None:
+            self._schema_decoder = EventSchemaDecoder(self.tokenizer)
+        input_ids = model_inputs["input_ids"][0]
+        prefix_len, prefix_kv = self._reusable_prefix(input_ids)
+        decoder = self._schema_decoder
+        forced, sampled = decoder.forced_tokens, decoder.model_tokens
+        output_text = decoder.generate(self.model, input_ids.tolist(), past_key_values=prefix_kv, prefix_len=prefix_len)
+        metrics.inc("tokens_generated_total", decoder.model_tokens - sampled, mode="model")
+        metrics.inc("tokens_generated_total", decoder.forced_tokens - forced, mode="forced")
+        return output_text
+
+
+    def _reusable_prefix(self, input_ids):
+        """input_ids が固定プレフィックスで始まっていれば (プレフィックス長, KVキャッシュの複製) を返す"""
+        if not (self.prefix_cache and self.backend.supports_prefix_cache):
+            return 0, None
+        prefix_ids, prefix_kv = self._prefix_kv()
+        if prefix_kv is None or len(input_ids) <= len(prefix_ids) or input_ids[:len(prefix_ids)].tolist() != prefix_ids:
+            return 0, None
+        return len(prefix_ids), copy.deepcopy(prefix_kv)
 
-この文章から、次の形式で予定の情報を抽出してください：
+
+    def _prefix_kv(self):
+        """
+        プロンプトの固定プレフィックス部分のトークン列とKVキャッシュを返す
+
+        プレフィックスは入力や日付に依存しないので、モデルごとに一度だけ計算する
+        """
+        with self._prefix_lock:
+            if self._prefix is None:
+                import torch
+
+                prompt = self._build_prompt("")
+                prefix_text = prompt[:prompt.index(self._prompt_suffix(""))]
+                prefix_ids = self.tokenizer([prefix_text], return_tensors="pt").input_ids.to(self.model.device)
+                # トークン境界がずれる場合はキャッシュを使わない
+                full_ids = self.tokenizer([prompt], return_tensors="pt").input_ids[0].tolist()
+                if full_ids[:prefix_ids.shape[1]] != prefix_ids[0].tolist():
+                    self._prefix = (prefix_ids[0].tolist(), None)
+                else:
+                    with torch.no_grad():
+                        outputs = self.model(input_ids=prefix_ids, use_cache=True)
+                    self._prefix = (prefix_ids[0].tolist(), outputs.past_key_values)
+            return self._prefix
+
+
+    def _prompt_prefix(self):
+        # 入力によらない固定部分（KVキャッシュを再利用するため、可変部分より前に置く）
+        return """以下は、予定に関する自然言語の文章から予定の情報を抽出するタスクです。
+
+文章から、次の形式で予定の情報を抽出してください：
 - action: 予定の追加/変更/削除のいずれか
 - title: 予定の名前
 - start: 開始日時（変更の場合は変更後開始日時）
@@ -107,11 +519,24 @@ class LLMEventParser(BaseParser):
 - all_day: 終日か否か
 - original_title: 変更前の名前（変更しない場合はtitleと同じ）
 - original_start: 変更前の開始日時（変更しない場合はstartと同じ）
+- rrule: 繰り返しの規則（RRULE形式。例: 毎週月曜は "FREQ=WEEKLY;BYDAY=MO"、毎月15日は "FREQ=MONTHLY;BYMONTHDAY=15"）（繰り返さない場合は ""）（startは最初の回）
+
+出力形式:
+{"action": "add"/"modify"/"delete", "title": "...", "start": "yyyy-mm-ddThh:mm:ss", "end": "yyyy-mm-ddThh:mm:ss", "all_day": true/false, "original_title": "...", "original_start": "yyyy-mm-ddThh:mm:ss", "rrule": "..."}
+
+"""
+
 
-出力形式:""""""
-{"action": "add"/"modify"/"delete", "title": "...", "start": "yyyy-mm-ddThh:mm:ss", "end": "yyyy-mm-ddThh:mm:ss", "all_day": true/false, "original_title": "...", "original_start": "yyyy-mm-ddThh:mm:ss"}
+    def _prompt_suffix(self, user_input: str):
+        return f"""今日の日付は {self.reference_time.strftime("%Y年%m月%d日")} です。文章に「明日」「明後日」などの表現がある場合は、これを基準に日時を解釈してください。
+
+文章: 「{user_input}」
 
 出力:"""
+
+
+    def _build_prompt(self, user_input: str):
+        prompt = self._prompt_prefix() + self._prompt_suffix(user_input)
         
         messages = [
             {"role": "user", "content": prompt}
@@ -127,11 +552,404 @@ class LLMEventParser(BaseParser):
         return text
 
     def _extract_json_like(self, text: str) -> str:
-        """LLM出力からJSONに似た部分だけ抽出する簡易関数"""
-        import re
-        match = re.search(r"\{[\s\S]*?\}", text)
-        return match.group(0) if match else "{}"
+        """LLM出力から括弧の対応が取れたJSONオブジェクト部分だけ抽出する"""
+        end = _json_object_end(text)
+        return text[text.find("{"):end] if end is not None else "{}"
+
+
+
+class BackgroundParserLoader:
+    """
+    Builds a parser in a background thread
+
+    `factory` is called once on a daemon thread (followed by `warmup()` when requested).
+    `get()` returns the parser once it is ready, or None while it is still loading.
+    """
+    def __init__(self, factory, warmup: bool = False, start: bool = True):
+        self.factory = factory
+        self.warmup = warmup
+        self.error = None
+
+        self._parser = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._load, name="parser-loader", daemon=True)
+        if start:
+            self.start()
+
+    def start(self):
+        if not self._thread.is_alive() and not self._ready.is_set():
+            self._thread.start()
+
+    def ready(self) -> bool:
+        return self._ready.is_set() and self.error is None
+
+    def get(self, timeout: float = 0):
+        """読み込み済みのパーサを返す（読み込み中なら None、読み込みに失敗していればその例外を送出）"""
+        self._ready.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self._parser
+
+    def _load(self):
+        try:
+            parser = self.factory()
+            if self.warmup and hasattr(parser, "warmup"):
+                parser.warmup()
+            self._parser = parser
+        except Exception as e:
+            self.error = e
+        finally:
+            self._ready.set()
+
+
+
+# ルールベース解析用のパターン（import時に一度だけコンパイル）
+_RELATIVE_DAYS = {"今日": 0, "本日": 0, "明日": 1, "明後日": 2, "あさって": 2}
+_RELATIVE_RE = re.compile(r"明後日|あさって|明日|今日|本日")
+_DATE_RE = re.compile(r"(?:(\d{4})[/年\-])?(\d{1,2})[/月](\d{1,2})日?")
+_TIME = r"(午前|午後)?(\d{1,2})(?:[:：](\d{2})|時(?!間)(?:(\d{1,2})分|(半))?)"
+_TIME_RE = re.compile(
+    _TIME
+    + r"(?:\s*(?:から|〜|～|~|-|ー|－)\s*(?:(\d{1,2}(?:\.\d+)?)時間(半)?"
+    + r"|((?:午前|午後)?\d{1,2}(?:[:：]\d{2}|時(?!間)(?:\d{1,2}分|半)?))))?"
+)
+_END_TIME_RE = re.compile(_TIME)
+_ALL_DAY_RE = re.compile(r"終日|一日中")
+# 変更・削除を示唆する語（ルールでは扱わずLLMに回す）
+_EDIT_ACTION_RE = re.compile(r"変更|移動|ずら|延期|削除|消し|消去|取り消|キャンセル|中止|やめ")
+# 繰り返し（毎日 / 平日 / 毎週・隔週の曜日 / 毎月の日 / 毎年）
+_RECURRENCE_RE = re.compile(r"毎日|平日|(毎週|隔週)([月火水木金土日])曜日?|毎月(\d{1,2})日|毎年")
+_WEEKDAYS_JA = "月火水木金土日"
+# ルールでは解釈できない時間表現（繰り返し表現を除いた部分で判定する）
+_UNSUPPORTED_RE = re.compile(r"来週|再来週|来月|毎|後に|日後|週間後|朝|昼|夕方|夜|週末|曜")
+# 「空いている時間に」: 時刻の代わりに探す範囲（時間帯）と長さを返す
+_FREE_SLOT_RE = re.compile(r"(?:空いている|空いてる|空き)時間")
+_FREE_SLOT_PERIOD_RE = re.compile(r"午前中?|午後|夕方|夜")
+_FREE_SLOT_WINDOWS = {"午前": (9, 12), "午前中": (9, 12), "午後": (13, 18), "夕方": (16, 19), "夜": (18, 22), None: (9, 18)}
+_DURATION_RE = re.compile(r"(\d{1,2}(?:\.\d+)?)時間(半)?|(\d{1,3})分間?")
+_TITLE_TRIM_RE = re.compile(r"^(?:から|まで|に|で|は|の|を|、|。|\s)+|(?:から|まで|に|で|は|を|、|。|\s)+$")
+
+
+class RuleEventParser(BaseParser):
+    """
+    Deterministic regex parser for simple inputs
+
+    Emits the same dict schema as `LLMEventParser` together with a confidence score.
+    Only "add" requests with explicit dates/times or 今日/明日/明後日 are handled with high confidence.
+    Requests for a free slot (空いている時間に) additionally carry a "free_slot" search window.
+    """
+    def __init__(self, reference_time=None, **kwargs):
+        super().__init__(reference_time=reference_time or event_model.now(), **kwargs)
+
+    def parse(self, text: str):
+        result, _ = self.parse_with_confidence(text)
+        return result
+
+    def parse_with_confidence(self, text: str):
+        """解析結果の辞書と確信度（0.0～1.0）を返す"""
+        text = text.strip()
+        confidence = 1.0
+        spans = []
+
+        if _EDIT_ACTION_RE.search(text):
+            confidence = 0.0
+
+        # 繰り返し
+        rrule = ""
+        recurrence_match = _RECURRENCE_RE.search(text)
+        if recurrence_match:
+            rrule = self._rrule(recurrence_match)
+            spans.append(recurrence_match.span())
 
+        # 空き時間の指定（時間帯と長さ）
+        free_match = _FREE_SLOT_RE.search(text)
+        period_match = duration_match = None
+        if free_match:
+            period_match = _FREE_SLOT_PERIOD_RE.search(text)
+            duration_match = _DURATION_RE.search(text)
+            spans.extend(m.span() for m in (free_match, period_match, duration_match) if m)
+
+        # 繰り返し・空き時間の表現を除いた部分で判定する
+        checked = self._mask(text, spans)
+        if _UNSUPPORTED_RE.search(checked):
+            confidence -= 0.5
+
+        # 日付
+        day = None
+        date_match = _DATE_RE.search(text)
+        relative_match = _RELATIVE_RE.search(text)
+        if date_match:
+            year, month, mday = date_match.groups()
+            try:
+                day = datetime(int(year) if year else self.reference_time.year, int(month), int(mday))
+            except ValueError:
+                confidence -= 0.5
+            spans.append(date_match.span())
+        if relative_match:
+            if day is None:
+                base = self.reference_time + timedelta(days=_RELATIVE_DAYS[relative_match.group(0)])
+                day = datetime(base.year, base.month, base.day)
+            else:
+                # 明示的な日付と相対表現が両方ある場合は曖昧
+                confidence -= 0.5
+            spans.append(relative_match.span())
+        if day is None:
+            day = datetime(self.reference_time.year, self.reference_time.month, self.reference_time.day)
+            # 毎年以外の繰り返しは日付がなくても最初の回が決まる
+            if not rrule or rrule.startswith("FREQ=YEARLY"):
+                confidence -= 0.5
+        if rrule:
+            # 最初の回（基準日以降で規則に合う最初の日）
+            day = next(recurrence.iter_starts(recurrence.parse_rrule(rrule), day), day)
+
+        # 時刻
+        time_match = _TIME_RE.search(text)
+        all_day_match = _ALL_DAY_RE.search(text)
+        free_slot = None
+        if free_match:
+            # start / end は仮の値で、保存先の予定から空きを探して決める（`event_storage.resolve_free_slot`）
+            first, last = _FREE_SLOT_WINDOWS[period_match.group(0) if period_match else None]
+            minutes = 60
+            if duration_match and duration_match.group(1):
+                minutes = round((float(duration_match.group(1)) + (0.5 if duration_match.group(2) else 0)) * 60)
+            elif duration_match:
+                minutes = int(duration_match.group(3))
+            start = day + timedelta(hours=first)
+            end = start + timedelta(minutes=minutes)
+            all_day = False
+            free_slot = {"window_start": start.isoformat(),
+                         "window_end": (day + timedelta(hours=last)).isoformat(),
+                         "duration_minutes": minutes}
+            # 時刻の指定や繰り返しとの組み合わせはルールでは扱わない
+            if time_match or all_day_match or rrule or minutes <= 0:
+                confidence -= 0.5
+        elif time_match:
+            start = self._combine(day, *time_match.group(1, 2, 3, 4, 5))
+            end = None
+            if start is None:
+                confidence -= 0.5
+                start = day
+            if time_match.group(6):
+                hours = float(time_match.group(6)) + (0.5 if time_match.group(7) else 0)
+                end = start + timedelta(hours=hours)
+            elif time_match.group(8):
+                end = self._combine(day, *_END_TIME_RE.fullmatch(time_match.group(8)).groups())
+                if end is None:
+                    confidence -= 0.5
+            if end is None:
+                end = start + timedelta(hours=1)
+            elif end <= start:
+                # 「22時から1時」のような日跨ぎ
+                end += timedelta(days=1)
+            all_day = False
+            spans.append(time_match.span())
+            if all_day_match:
+                confidence -= 0.5
+        else:
+            start = day
+            end = day + timedelta(days=1)
+            all_day = True
+            if all_day_match:
+                spans.append(all_day_match.span())
+            elif not (date_match or relative_match or recurrence_match):
+                confidence -= 0.3
+
+        # タイトル: 日時部分を除いた残り
+        title = _TITLE_TRIM_RE.sub("", re.sub(r"\s+", " ", self._mask(text, spans)).strip())
+        if not title:
+            title = "無題の予定"
+            confidence -= 0.5
+        elif re.search(r"\d", title):
+            # 解釈できなかった数値表現が残っている
+            confidence -= 0.4
+
+        start_str = start.isoformat()
+        result = {
+            "action": "add",
+            "title": title,
+            "start": start_str,
+            "end": end.isoformat(),
+            "all_day": all_day,
+            "original_title": title,
+            "original_start": start_str,
+            "rrule": rrule,
+        }
+        if free_slot is not None:
+            result["free_slot"] = free_slot
+        return result, max(0.0, min(1.0, confidence))
+
+    @staticmethod
+    def _mask(text, spans):
+        # 範囲が重なっていてもよいように文字単位で空白に置き換える
+        chars = list(text)
+        for s, e in spans:
+            chars[s:e] = " " * (e - s)
+        return "".join(chars)
+
+    @staticmethod
+    def _rrule(match) -> str:
+        text = match.group(0)
+        if text == "毎日":
+            return recurrence.format_rrule("DAILY")
+        if text == "平日":
+            return recurrence.format_rrule("WEEKLY", byday=range(5))
+        if text == "毎年":
+            return recurrence.format_rrule("YEARLY")
+        if match.group(3):
+            return recurrence.format_rrule("MONTHLY", bymonthday=[int(match.group(3))])
+        return recurrence.format_rrule("WEEKLY",
+                                       interval=2 if match.group(1) == "隔週" else 1,
+                                       byday=[_WEEKDAYS_JA.index(match.group(2))])
+
+    @staticmethod
+    def _combine(day, meridiem, hour, minute, minute_ja, half):
+        hour = int(hour)
+        minute = int(minute or minute_ja or (30 if half else 0))
+        if meridiem == "午後" and hour < 12:
+            hour += 12
+        if hour > 24 or minute > 59:
+            return None
+        return day + timedelta(hours=hour, minutes=minute)
+
+
+
+class HybridEventParser(BaseParser):
+    """
+    Rule-first parser with LLM fallback
+
+    `RuleEventParser` handles the input when its confidence is at least `threshold`;
+    otherwise the request is forwarded to the LLM parser.
+    The path taken is recorded in `last_path` ("rule" or "llm") and counted in `path_counts`.
+    `llm_parser` may also be a `BackgroundParserLoader`; until it is ready only the rule path is available.
+    """
+    def __init__(self, reference_time=None, llm_parser=None, threshold: float = 0.8, **kwargs):
+        super().__init__(reference_time=reference_time or event_model.now(), **kwargs)
+        self.rule_parser = RuleEventParser(reference_time=self.reference_time)
+        self.llm_parser = llm_parser
+        self.threshold = threshold
+        self.last_path = None
+        self.path_counts = {"rule": 0, "llm": 0}
+
+    @property
+    def reference_time(self):
+        return self._reference_time
+
+    @reference_time.setter
+    def reference_time(self, value):
+        # 長く使い回す場合に更新した基準時刻を、ルール・LLMの両方で使う
+        self._reference_time = value
+        if getattr(self, "rule_parser", None) is not None:
+            self.rule_parser.reference_time = value
+
+    def parse(self, text: str):
+        result, confidence = self.rule_parser.parse_with_confidence(text)
+        if confidence >= self.threshold:
+            self._record("rule")
+            return result
+
+        llm_parser = self._llm()
+        if llm_parser is None:
+            raise ValueError(self._unavailable_message(text))
+        self._record("llm")
+        return llm_parser.parse(text)
+
+    def parse_stream(self, text: str) -> ParseStream:
+        """`parse` のストリーミング版（ルールで処理した場合やLLMが非対応の場合はチャンクなし）"""
+        result, confidence = self.rule_parser.parse_with_confidence(text)
+        if confidence >= self.threshold:
+            self._record("rule")
+            return ParseStream((), lambda _: result)
+
+        llm_parser = self._llm()
+        if llm_parser is None:
+            raise ValueError(self._unavailable_message(text))
+        self._record("llm")
+        if hasattr(llm_parser, "parse_stream"):
+            return llm_parser.parse_stream(text)
+        return ParseStream((), lambda _: llm_parser.parse(text))
+
+    def llm_ready(self) -> bool:
+        if isinstance(self.llm_parser, BackgroundParserLoader):
+            return self.llm_parser.ready()
+        return self.llm_parser is not None
+
+    def parse_many(self, texts, batch_size: int = 8):
+        """`LLMEventParser.parse_many` と同じ形式で返す。経路は `last_paths` に入る"""
+        texts = list(texts)
+        results = [None] * len(texts)
+        self.last_paths = [None] * len(texts)
+        fallback = []
+        for i, text in enumerate(texts):
+            result, confidence = self.rule_parser.parse_with_confidence(text)
+            if confidence >= self.threshold:
+                results[i] = result
+                self.last_paths[i] = "rule"
+                self.path_counts["rule"] += 1
+                metrics.inc("parse_requests_total", path="rule")
+            else:
+                fallback.append(i)
+        if not fallback:
+            return results
+
+        # LLMはルールで処理できなかった入力があるときだけ使う（読み込みの失敗はその入力ごとのエラーにする）
+        try:
+            llm_parser = self._llm()
+        except ValueError as e:
+            for i in fallback:
+                results[i] = ValueError(f"{e}: {texts[i]}")
+            return results
+        if llm_parser is None:
+            for i in fallback:
+                results[i] = ValueError(self._unavailable_message(texts[i]))
+        else:
+            for i, result in zip(fallback, llm_parser.parse_many([texts[i] for i in fallback], batch_size=batch_size)):
+                results[i] = result
+                self.last_paths[i] = "llm"
+                self.path_counts["llm"] += 1
+                metrics.inc("parse_requests_total", path="llm")
+        return results
+
+    def _llm(self):
+        """LLMパーサ（読み込み中なら None、読み込みに失敗していれば ValueError）"""
+        llm_parser = self.llm_parser
+        if isinstance(llm_parser, BackgroundParserLoader):
+            try:
+                llm_parser = llm_parser.get()
+            except Exception as e:
+                raise ValueError(f"言語モデルの読み込みに失敗したため、ルールベースで解析できない入力は処理できません（{e}）")
+        if llm_parser is not None:
+            llm_parser.reference_time = self.reference_time
+        return llm_parser
+
+    def _unavailable_message(self, text):
+        if isinstance(self.llm_parser, BackgroundParserLoader):
+            return f"言語モデルを読み込み中のため、ルールベースで解析できない入力は処理できません: {text}"
+        return f"ルールベースで解析できず、LLMも設定されていません: {text}"
+
+    def _record(self, path: str):
+        self.last_path = path
+        self.path_counts[path] += 1
+        metrics.inc("parse_requests_total", path=path)
+
+
+
+# FormatEventParser用の単一パススキャナ（import時に一度だけコンパイル）
+_FORMAT_DATE = r'\d{4}[\/年]\d{1,2}[\/月]\d{1,2}'
+_FORMAT_SCANNER = re.compile(
+    r'(?P<relative>明後日|明日|今日)'
+    r'|(?P<date_range>(?P<range_start>' + _FORMAT_DATE + r')[\s〜～\-]*(?P<range_end>' + _FORMAT_DATE + r'))'
+    r'|(?P<date>' + _FORMAT_DATE + r')'
+    r'|(?P<time_range>(?P<sh>\d{1,2})[:時](?P<sm>\d{1,2})?(?:[\s〜～\-ー]|から)+(?P<eh>\d{1,2})[:時](?P<em>\d{1,2})?)'
+    r'|(?P<time>(?P<h>\d{1,2})[:時](?P<m>\d{1,2})?)'
+)
+_FORMAT_RELATIVE_DAYS = {'今日': 0, '明日': 1, '明後日': 2}
+_FORMAT_DIGITS = re.compile(r'\d+')
+_FORMAT_TITLE_SPLIT = re.compile(r'[\s\-〜～、。]')
+
+
+def _format_date(text: str) -> datetime:
+    year, month, day = map(int, _FORMAT_DIGITS.findall(text))
+    return datetime(year, month, day)
 
 
 @deprecated("This class is not recommended for use in natural language parsing modules. Use LLMEventParser instead.")
@@ -148,56 +966,52 @@ class FormatEventParser(BaseParser):
         title, start_datetime, end_datetime, all_day の4つを返す
         """
         original_text = text.strip()
-        text = original_text
 
-        # 相対表現変換（明日、明後日など）
-        relative_replacements = {
-            '明後日': (self.reference_time + timedelta(days=2)).strftime('%Y-%m-%d'),
-            '明日': (self.reference_time + timedelta(days=1)).strftime('%Y-%m-%d'),
-            '今日': self.reference_time.strftime('%Y-%m-%d'),
-        }
-        for key, val in relative_replacements.items():
-            text = text.replace(key, val)
+        # 日付・時刻・相対表現（明日、明後日など）を一度の走査で抽出
+        found = {}
+        spans = []
+        for match in _FORMAT_SCANNER.finditer(original_text):
+            found.setdefault(match.lastgroup, match)
+            spans.append(match.span())
 
-        # 日時情報の抽出
-        time_range_pattern = r'(\d{1,2})[:時](\d{1,2})?[\s〜～-から〜ー]+(\d{1,2})[:時](\d{1,2})?'
-        single_time_pattern = r'(\d{1,2})[:時](\d{1,2})?'
-        date_range_pattern = r'(\d{4}[\/年]\d{1,2}[\/月]\d{1,2})[\s〜～-]*(\d{4}[\/年]\d{1,2}[\/月]\d{1,2})'
-        single_date_pattern = r'(\d{4}[\/年]\d{1,2}[\/月]\d{1,2})'
-
-        time_range_match = re.search(time_range_pattern, text)
-        single_time_match = re.search(single_time_pattern, text)
-        date_range_match = re.search(date_range_pattern, text)
-        single_date_match = re.search(single_date_pattern, text)
+        date_range_match = found.get('date_range')
+        single_date_match = found.get('date')
+        relative_match = found.get('relative')
+        time_range_match = found.get('time_range')
+        single_time_match = found.get('time')
 
         has_time = bool(time_range_match or single_time_match)
-        has_date = bool(date_range_match or single_date_match)
 
         # 日付と時刻の初期値
         start = self.reference_time + timedelta(days=1)
         end = start + timedelta(hours=1)
         all_day = not has_time
 
+        # 単一日付の基準日（明示的な日付がなければ相対表現から求める）
+        base_date = None
+        if single_date_match:
+            base_date = _format_date(single_date_match.group())
+        elif relative_match:
+            base_date = datetime(self.reference_time.year, self.reference_time.month, self.reference_time.day) \
+                + timedelta(days=_FORMAT_RELATIVE_DAYS[relative_match.group()])
+
         # 日付レンジ処理
         if date_range_match:
-            start = dateparser.parse(date_range_match.group(1), settings={'RELATIVE_BASE': self.reference_time})
-            end = dateparser.parse(date_range_match.group(2), settings={'RELATIVE_BASE': self.reference_time}) + timedelta(days=1)
+            start = _format_date(date_range_match.group('range_start'))
+            end = _format_date(date_range_match.group('range_end')) + timedelta(days=1)
             all_day = True
 
         # 単一日付＋時刻 or 単独時刻処理
-        elif single_date_match:
-            start = dateparser.parse(single_date_match.group(1), settings={'RELATIVE_BASE': self.reference_time})
+        elif base_date is not None:
+            start = base_date
             if time_range_match:
-                sh, sm, eh, em = time_range_match.groups()
-                start = start.replace(hour=int(sh), minute=int(sm or 0))
-                end = start.replace(hour=int(eh), minute=int(em or 0))
+                start = start.replace(hour=int(time_range_match.group('sh')), minute=int(time_range_match.group('sm') or 0))
+                end = start.replace(hour=int(time_range_match.group('eh')), minute=int(time_range_match.group('em') or 0))
                 if end <= start:
                     end = start + timedelta(hours=1)
                 all_day = False
             elif single_time_match:
-                hour = int(single_time_match.group(1))
-                minute = int(single_time_match.group(2)) if single_time_match.group(2) else 0
-                start = start.replace(hour=hour, minute=minute)
+                start = start.replace(hour=int(single_time_match.group('h')), minute=int(single_time_match.group('m') or 0))
                 end = start + timedelta(hours=1)
                 all_day = False
             else:
@@ -205,28 +1019,29 @@ class FormatEventParser(BaseParser):
                 all_day = True
 
         # 時刻だけある（"10時から12時"のような場合）
-        elif time_range_match and not single_date_match:
+        elif time_range_match:
             start = self.reference_time
-            sh, sm, eh, em = time_range_match.groups()
-            start = start.replace(hour=int(sh), minute=int(sm or 0))
-            end = start.replace(hour=int(eh), minute=int(em or 0))
+            start = start.replace(hour=int(time_range_match.group('sh')), minute=int(time_range_match.group('sm') or 0))
+            end = start.replace(hour=int(time_range_match.group('eh')), minute=int(time_range_match.group('em') or 0))
             if end <= start:
                 end = start + timedelta(hours=1)
             all_day = False
 
-        elif single_time_match and not single_date_match:
-            hour = int(single_time_match.group(1))
-            minute = int(single_time_match.group(2)) if single_time_match.group(2) else 0
-            start = start.replace(hour=hour, minute=minute)
+        elif single_time_match:
+            start = start.replace(hour=int(single_time_match.group('h')), minute=int(single_time_match.group('m') or 0))
             end = start + timedelta(hours=1)
             all_day = False
 
-        # titleの抽出：既知の日時部分を除去した残り
-        cleaned_text = original_text
-        for pattern in [time_range_pattern, single_time_pattern, date_range_pattern, single_date_pattern] + list(relative_replacements.keys()):
-            cleaned_text = re.sub(pattern, '', cleaned_text)
+        # titleの抽出：走査で見つかった日時部分を除去した残り
+        pieces = []
+        pos = 0
+        for s, e in spans:
+            pieces.append(original_text[pos:s])
+            pos = e
+        pieces.append(original_text[pos:])
+        cleaned_text = ''.join(pieces)
 
-        title_candidates = re.split(r'[\s\-〜～、。]', cleaned_text.strip())
+        title_candidates = _FORMAT_TITLE_SPLIT.split(cleaned_text.strip())
         title = next((t for t in reversed(title_candidates) if t), "無題の予定")
 
         return title.strip(), start.isoformat(), end.isoformat(), all_day
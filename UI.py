@@ -15,22 +15,114 @@
 import streamlit as st
 from streamlit_calendar import calendar
 from datetime import datetime, timedelta
+import io
+import os
 import uuid
 
-from event_storage import load_events, save_events
+import calendar_io
+import event_model
+import metrics
+import recurrence
+from event_model import Event
+from event_storage import (DEFAULT_CALENDAR, VersionConflict, apply_changes, calendar_name, delete_occurrence,
+                           get_store, resolve_free_slot)
 
 
 # LLMEventParserの読み込み関数で隔離（watcher対策）
-@st.cache_resource(show_spinner="モジュールを読み込んでいます...")
+# モデルはバックグラウンドで読み込み、その間もカレンダーと形式入力は使えるようにする
+@st.cache_resource(show_spinner=False)
 def get_llm_parser():
-    from NLParser import LLMEventParser
-    return LLMEventParser()  # パスは適宜書き換えてください
+    from NLParser import LLMEventParser, HybridEventParser, BackgroundParserLoader
+    from parse_cache import ParseCache
+    if os.getenv("PARSE_SERVER_URL"):
+        # 解析サーバ（parse_server.py）が設定されていればモデルはそちらで共有する
+        from parse_server import RemoteEventParser
+        llm_parser = RemoteEventParser(os.getenv("PARSE_SERVER_URL"))
+    else:
+        # 制約付きデコーディングでは出力が常にJSONとして解析できる（CONSTRAINED_DECODING = 0 で無効化）
+        constrained = os.getenv("CONSTRAINED_DECODING", "1") == "1"
+        llm_parser = BackgroundParserLoader(lambda: LLMEventParser(cache=ParseCache(), constrained=constrained),
+                                            warmup=True)  # パスは適宜書き換えてください
+    # 単純な入力はルールベースで処理し、確信度が低い場合のみLLMを使う
+    return HybridEventParser(llm_parser=llm_parser)
+
+
+
+# METRICS_PORT が設定されていれば /metrics を公開する（プロセスにつき1回）
+@st.cache_resource(show_spinner=False)
+def start_metrics_server():
+    if os.getenv("METRICS_PORT"):
+        return metrics.start_http_server(int(os.getenv("METRICS_PORT")))
+
+
+def default_calendar_range(today=None):
+    """月表示（前後の週を含む6週間）をカバーする初期表示範囲"""
+    today = today or event_model.now().replace(tzinfo=None)
+    first = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return (first - timedelta(days=7)).isoformat(), (first + timedelta(days=45)).isoformat()
 
 
+# 再実行ごとの処理時間をフェーズ別に記録する
+watch = metrics.stopwatch("ui_phase_seconds")
+start_metrics_server()
 
 # セッション状態の初期化
+if "calendar_range" not in st.session_state:
+    st.session_state["calendar_range"] = default_calendar_range()
+
+# 表示するカレンダー（?user=...&calendar=... でユーザー・カレンダーごとに分ける）
+calendar_key = calendar_name(st.query_params.get("user"), st.query_params.get("calendar", DEFAULT_CALENDAR))
+if st.session_state.get("calendar_name") != calendar_key:
+    st.session_state["calendar_name"] = calendar_key
+    st.session_state.pop("events", None)
+store = get_store(calendar_key)
+
+
+def load_visible_events():
+    """カレンダーの表示範囲にある予定だけを読み込む"""
+    # 読み込み中の変更を取りこぼさないよう、seq を先に取る
+    st.session_state["events_seq"] = store.current_seq()
+    set_events(store.query_range(*st.session_state["calendar_range"]))
+
+
+def set_events(events):
+    """
+    表示する予定を入れ替える（読み込み・変更のときだけ呼ぶ）
+
+    日時の解析や表示用のラベル・並び順はここで一度だけ計算し、再実行ごとには行わない
+    """
+    pairs = sorted(((Event.from_dict(e), e) for e in events), key=lambda pair: pair[0].sort_key)
+    st.session_state["events"] = [e for _, e in pairs]
+    st.session_state["event_models"] = [m for m, _ in pairs]
+    options = [f"{i+1}: {m.label}" for i, (m, _) in enumerate(pairs)]
+    st.session_state["event_options"] = options
+    st.session_state["event_option_index"] = {label: i for i, label in enumerate(options)}
+    # カレンダー上でクリックされた予定を (ID, 開始日時) で引く
+    st.session_state["event_lookup"] = {(m.id, m.start_iso): m for m, _ in pairs}
+
+
+def conflict_message(event, exclude_id=None):
+    """event と時間が重なる予定があれば警告文を返す（なければ None）"""
+    overlaps = store.conflicts(event, exclude_id=exclude_id)
+    if not overlaps:
+        return None
+    names = "、".join(f"{e['title']}（{e['start'][:16].replace('T', ' ')}）" for e in overlaps[:5])
+    more = f" ほか{len(overlaps) - 5}件" if len(overlaps) > 5 else ""
+    return f"次の予定と時間が重なっています: {names}{more}"
+
+
 if "events" not in st.session_state:
-    st.session_state["events"] = load_events()
+    load_visible_events()
+else:
+    # 前回の再実行以降の変更（他のセッションの書き込みを含む）だけを反映する
+    changes = store.changes_since(st.session_state["events_seq"])
+    if changes is None:
+        load_visible_events()
+    elif changes[1] or changes[2]:
+        st.session_state["events_seq"] = changes[0]
+        set_events(apply_changes(st.session_state["events"], changes, *st.session_state["calendar_range"]))
+        st.session_state["CalKey"] = str(uuid.uuid4())
+watch.lap("load_events")
 
 if "edit_index" not in st.session_state:
     st.session_state["edit_index"] = None
@@ -39,10 +131,16 @@ if "edit_index" not in st.session_state:
 st.header("NL Calendar")
 parser = get_llm_parser()
 
-tab1, tab2 = st.tabs(["自然言語入力", "形式入力"])
+tab1, tab2, tab3 = st.tabs(["自然言語入力", "形式入力", "インポート / エクスポート"])
 
 with tab1:
     st.text("※予定変更処理は, 具体的な時間（2025/4/1など）を指定するとうまくいきやすいです。")
+    if getattr(parser.llm_parser, "error", None) is not None:
+        st.warning(f"言語モデルの読み込みに失敗しました: {parser.llm_parser.error}")
+    elif not parser.llm_ready():
+        st.info("言語モデルを読み込み中です。日時が明確な予定の追加はこのまま解析できます。")
+    if "conflict_notice" in st.session_state:
+        st.warning(st.session_state.pop("conflict_notice"))
     if "natural_text_input" not in st.session_state:
         st.session_state["natural_text_input"] = ""
 
@@ -55,46 +153,76 @@ with tab1:
     if st.button("解析") or st.session_state.get("trigger_parse"):
         try:
             input_text = st.session_state["natural_text_input"]
-            result = parser.parse(input_text)
-            print(f"parsed -> {result}")
+            # パーサはプロセスで共有して使い回すので、「今日」「明日」の基準時刻は解析ごとに更新する
+            parser.reference_time = event_model.now()
+            stream = parser.parse_stream(input_text)
+            # 生成途中の出力を表示する
+            progress = st.empty()
+            streamed_text = ""
+            for chunk in stream:
+                streamed_text += chunk
+                progress.code(streamed_text, language="json")
+            progress.empty()
+            result = stream.result()
             action = result.get("action", "add")
             if action == "add":
+                # 「空いている時間に」は既存の予定と重ならない最初の時間帯に決める
+                result = resolve_free_slot(result, store, not_before=event_model.now())
                 st.session_state["parsed_event"] = {
                     "title": result["title"],
                     "start": result["start"],
                     "end": result["end"],
                     "allDay": result["all_day"]
                 }
+                if result.get("rrule"):
+                    recurrence.parse_rrule(result["rrule"])  # 不正な規則はここで ValueError
+                    st.session_state["parsed_event"]["rrule"] = result["rrule"]
             elif action == "modify":
                 # 編集対象を検索
-                index_to_update = next(
-                    (i for i, e in enumerate(st.session_state["events"])
-                     if e["title"] == result["original_title"]
-                     and e["start"].startswith(result["original_start"][:16])  # 時分まで比較
-                    ), None)
-                if index_to_update is not None:
-                    st.session_state["events"][index_to_update] = {
+                # (タイトル, 開始時分) の索引で検索し、なければ同日の予定からタイトルの近いものを選ぶ
+                targets = store.find(result["original_title"], result["original_start"])
+                if targets:
+                    updated = {
                         "title": result["title"],
                         "start": result["start"],
                         "end": result["end"],
                         "allDay": result["all_day"]
                     }
+                    # 繰り返し予定は、規則の指定がなければ元の規則を引き継ぐ
+                    rrule = result.get("rrule") or targets[0].get("rrule")
+                    if rrule:
+                        updated["rrule"] = rrule
+                    if targets[0].get("rrule"):
+                        # 指定された回の変更は系列の時刻・長さの変更にする（開始日は動かさない）
+                        updated = recurrence.apply_to_series(targets[0], result["original_start"], updated)
+                    notice = conflict_message(updated, exclude_id=targets[0]["id"])
+                    store.update(targets[0]["id"], updated, expected_version=targets[0].get("version"))
+                    if notice:
+                        st.session_state["conflict_notice"] = notice
                     st.success("予定を編集しました")
                     st.session_state["CalKey"] = str(uuid.uuid4())
-                    save_events(st.session_state["events"])
                     st.rerun()
                 else:
                     st.warning("該当する編集対象が見つかりませんでした")
             elif action == "delete":
-                st.session_state["events"] = [
-                    e for e in st.session_state["events"]
-                    if not (e["title"] == result["original_title"]
-                            and e["start"].startswith(result["original_start"][:16]))
-                ]
-                save_events(st.session_state["events"])
-                st.success("予定を削除しました")
-                st.session_state["CalKey"] = str(uuid.uuid4())
-                st.rerun()
+                # 削除は確認なしで行うので、別の時刻の似たタイトルの予定は対象にしない
+                targets = store.find(result["original_title"], result["original_start"], strict=True)
+                if targets:
+                    for e in targets:
+                        if e.get("rrule"):
+                            # 繰り返し予定は指定された日の回だけを削除する
+                            occurrence = recurrence.occurrence_on(e, result["original_start"])
+                            if occurrence is not None:
+                                delete_occurrence(store, e, occurrence, expected_version=e.get("version"))
+                        else:
+                            store.delete(e["id"], expected_version=e.get("version"))
+                    st.success("予定を削除しました")
+                    st.session_state["CalKey"] = str(uuid.uuid4())
+                    st.rerun()
+                else:
+                    st.warning("該当する削除対象が見つかりませんでした")
+        except VersionConflict:
+            st.error("対象の予定は他のユーザーによって更新されています。もう一度実行してください。")
         except Exception as e:
             st.error(f"予定の解析に失敗しました: {e}")
             st.session_state.pop("parsed_event", None)
@@ -106,24 +234,25 @@ with tab1:
     if "parsed_event" in st.session_state:
         parsed = st.session_state["parsed_event"]
 
-        start_dt = datetime.fromisoformat(parsed["start"])
-        end_dt = datetime.fromisoformat(parsed["end"])
+        parsed_model = Event.from_dict(parsed)
 
-        if parsed["allDay"]:
-            start_str = start_dt.strftime("%Y/%m/%d")
-            end_str = end_dt.strftime("%Y/%m/%d")  # 終日予定は範囲的
-            datetime_label = f"{start_str}～{end_str}（終日）"
+        if parsed_model.all_day:
+            datetime_label = f"{parsed_model.start_text}～{parsed_model.end_text}（終日）"  # 終日予定は範囲的
         else:
-            datetime_label = f"{start_dt.strftime('%Y/%m/%d %H:%M')}～{end_dt.strftime('%H:%M')}"
+            datetime_label = f"{parsed_model.start_text}～{parsed_model.end_text[-5:]}"
 
         st.markdown("### 📝 登録内容の確認")
         st.write(f"**日程**：{datetime_label}")
         st.write(f"**内容**：{parsed['title']}")
+        if parsed.get("rrule"):
+            st.write(f"**繰り返し**：{parsed['rrule']}")
+        notice = conflict_message(parsed)
+        if notice:
+            st.warning(notice)
         confirm_col1, confirm_col2 = st.columns(2)
         with confirm_col1:
             if st.button("登録", key="confirm_register"):
-                st.session_state["events"].append(parsed)
-                save_events(st.session_state["events"])
+                store.add(parsed)
                 st.session_state["CalKey"] = str(uuid.uuid4())
                 st.session_state.pop("parsed_event", None)
                 st.rerun()
@@ -131,16 +260,16 @@ with tab1:
             if st.button("キャンセル", key="cancel_register"):
                 st.session_state.pop("parsed_event", None)
 
+watch.lap("natural_language_tab")
 
 with tab2:
     st.subheader("形式入力")
 
     # 編集対象を選択
-    event_titles = [f"{i+1}: {e['title']} ({e['start']}～{e['end']})" for i, e in enumerate(st.session_state["events"])]
-    selected_event = st.selectbox("予定を選択（編集・削除）", ["新規追加"] + event_titles)
+    selected_event = st.selectbox("予定を選択（編集・削除）", ["新規追加"] + st.session_state["event_options"])
 
     is_edit = selected_event != "新規追加"
-    event_index = event_titles.index(selected_event) if is_edit else None
+    event_index = st.session_state["event_option_index"][selected_event] if is_edit else None
     event_data = st.session_state["events"][event_index] if is_edit else {}
 
     # 一時保存用セッションキー（新規追加時も維持）
@@ -150,29 +279,24 @@ with tab2:
     # キャッシュ初期化
     cache = st.session_state["form_cache"]
     if not is_edit and "init_done" not in cache:
-        now = datetime.now()
+        now = event_model.now()
         cache["title"] = "予定のタイトル"
         cache["allDay"] = True
         cache["start_date"] = now.date()
         cache["start_time"] = now.time().replace(second=0, microsecond=0)
         cache["end_date"] = (now + timedelta(days=1)).date()
         cache["end_time"] = now.time().replace(second=0, microsecond=0)
+        cache["rrule"] = ""
         cache["init_done"] = True
     elif is_edit:
-        start_dt = datetime.fromisoformat(event_data["start"])
-        end_dt = datetime.fromisoformat(event_data["end"])
-        cache["title"] = event_data["title"]
-        cache["allDay"] = event_data.get("allDay", True)
-        cache["start_date"] = start_dt.date()
-        cache["start_time"] = start_dt.time()
-        cache["end_date"] = end_dt.date()
-        cache["end_time"] = end_dt.time()
-
-    # 各フィールドの初期値
-    default_title = event_data.get("title", "")
-    default_start = datetime.fromisoformat(event_data.get("start", datetime.now().isoformat()))
-    default_end = datetime.fromisoformat(event_data.get("end", (datetime.now() + timedelta(days=1)).isoformat()))
-    default_all_day = event_data.get("allDay", True)
+        selected = st.session_state["event_models"][event_index]
+        cache["title"] = selected.title
+        cache["allDay"] = selected.all_day
+        cache["start_date"] = selected.start.date()
+        cache["start_time"] = selected.start.time()
+        cache["end_date"] = selected.end.date()
+        cache["end_time"] = selected.end.time()
+        cache["rrule"] = selected.rrule
 
     # 入力項目
     title = st.text_input("予定のタイトル", value=cache["title"], key="title_input")
@@ -186,6 +310,21 @@ with tab2:
         start_time = datetime.min.time()
         end_time = datetime.min.time()
     end_date = st.date_input("終了日", value=cache["end_date"], key="end_date_input")
+    rrule = st.text_input("繰り返し（RRULE形式、例: FREQ=WEEKLY;BYDAY=MO）", value=cache.get("rrule", ""), key="rrule_input")
+
+    # 入力中の日時と重なる予定があれば登録前に知らせる
+    form_event = {"start": datetime.combine(start_date, start_time).isoformat(),
+                  "end": datetime.combine(end_date, end_time).isoformat(),
+                  "allDay": all_day}
+    try:
+        if rrule.strip():
+            recurrence.parse_rrule(rrule.strip())
+            form_event["rrule"] = rrule.strip()
+        notice = conflict_message(form_event, exclude_id=event_data.get("id"))
+    except ValueError:
+        notice = None  # 不正な入力は登録時に知らせる
+    if notice:
+        st.warning(notice)
 
     # 登録ボタン群
     col1, col2 = st.columns(2)
@@ -199,22 +338,80 @@ with tab2:
                 "end": end_dt.isoformat(),
                 "allDay": all_day
             }
-            if is_edit:
-                st.session_state["events"][event_index] = new_event
-            else:
-                st.session_state["events"].append(new_event)
+            if rrule.strip():
+                try:
+                    recurrence.parse_rrule(rrule.strip())
+                except ValueError as e:
+                    st.error(f"繰り返しの指定が不正です: {e}")
+                    st.stop()
+                new_event["rrule"] = rrule.strip()
+            try:
+                if is_edit and event_data.get("groupId") and new_event.get("rrule"):
+                    # 表示しているのは繰り返し予定の1回なので、系列の開始日を動かさずに時刻・長さなどを反映する
+                    new_event = recurrence.apply_to_series({**event_data, "start": event_data["seriesStart"]},
+                                                           event_data["start"], new_event)
+                if is_edit:
+                    # 表示中の版から他のセッションが更新していれば上書きしない
+                    store.update(event_data["id"], new_event, expected_version=event_data.get("version"))
+                else:
+                    store.add(new_event)
+            except VersionConflict:
+                st.error("この予定は他のユーザーによって更新されています。最新の内容を確認してから編集してください。")
+                st.stop()
+            except ValueError as e:
+                st.error(str(e))
+                st.stop()
             st.session_state.pop("form_cache", None)  # キャッシュクリア
-            save_events(st.session_state["events"])
             st.session_state["CalKey"] = str(uuid.uuid4())
             st.rerun()
 
     with col2:
-        if is_edit and st.button("この予定を削除"):
-            st.session_state["events"].pop(event_index)
-            save_events(st.session_state["events"])
+        # 繰り返し予定の1回を選んでいる場合は、その回だけか繰り返し全体かを選べる
+        delete_one = is_edit and event_data.get("groupId") and st.button("この回だけ削除")
+        delete_all = is_edit and st.button("繰り返し全体を削除" if event_data.get("groupId") else "この予定を削除")
+        if delete_one or delete_all:
+            try:
+                if delete_one:
+                    series = store.get(event_data["id"])
+                    if series is None:
+                        # 表示してから他のセッションが系列を削除した
+                        raise VersionConflict(event_data["id"], event_data.get("version"))
+                    delete_occurrence(store, series, event_data["start"], expected_version=event_data.get("version"))
+                else:
+                    store.delete(event_data["id"], expected_version=event_data.get("version"))
+            except VersionConflict:
+                st.error("この予定は他のユーザーによって更新されています。最新の内容を確認してから削除してください。")
+                st.stop()
             st.session_state["CalKey"] = str(uuid.uuid4())
             st.rerun()
 
+watch.lap("form_tab")
+
+with tab3:
+    uploaded = st.file_uploader("ICS / CSV ファイル", type=["ics", "csv"])
+    st.caption("CSVは title, start, end, all_day, rrule 列、または自然言語の text 列を読み込みます。")
+    if uploaded is not None and st.button("インポート"):
+        lines = io.TextIOWrapper(uploaded, encoding="utf-8-sig", newline="")
+        if uploaded.name.lower().endswith(".ics"):
+            report = calendar_io.import_ics(lines, store)
+        else:
+            parser.reference_time = event_model.now()
+            report = calendar_io.import_csv(lines, store, parser=parser)
+        st.success(f"{report.imported} 件の予定をインポートしました")
+        for line_no, message in report.failed[:20]:
+            st.warning(f"{line_no} 行目: {message}")
+        if report.imported:
+            # 結果のメッセージを残すため、再実行せずにこの場で読み直す
+            load_visible_events()
+            st.session_state["CalKey"] = str(uuid.uuid4())
+
+    if st.button("ICSを作成"):
+        exported = io.StringIO()
+        count = calendar_io.export_ics(store.iter_all(), exported)
+        st.download_button(f"ICSをダウンロード（{count} 件）", exported.getvalue().encode("utf-8"),
+                           file_name="nlcalendar.ics", mime="text/calendar")
+
+watch.lap("import_export_tab")
 
 
 # カレンダーの表示
@@ -224,37 +421,46 @@ calendar_options = {
     "initialView": "dayGridMonth",
     "height": 700,
 }
+if "calendar_initial_date" in st.session_state:
+    calendar_options["initialDate"] = st.session_state["calendar_initial_date"]
 
 event_return = calendar(
     events=st.session_state["events"],
     options=calendar_options,
+    callbacks=["dateClick", "eventClick", "eventChange", "eventsSet", "select", "datesSet"],
     key=st.session_state.get("CalKey", "default")
 )
+watch.lap("calendar_render")
+
+# 表示範囲が変わったら、その範囲の予定を読み直す
+if event_return.get("datesSet") is not None:
+    dates_set = event_return["datesSet"]
+    visible_range = (dates_set["start"], dates_set["end"])
+    if visible_range != st.session_state["calendar_range"]:
+        st.session_state["calendar_range"] = visible_range
+        st.session_state["calendar_initial_date"] = dates_set.get("view", {}).get("currentStart", dates_set["start"])
+        st.session_state.pop("events", None)
+        st.rerun()
 
 # イベントがクリックされたときの詳細表示
 if event_return.get("eventClick") is not None:
     event_click = event_return.get("eventClick")
     event = event_click["event"]
 
-    title = event.get("title", "")
-    start = event.get("start", "")
-    end = event.get("end", "")
-    all_day = event.get("allDay", False)
-
-    start_dt = datetime.fromisoformat(start)
-    start_str = start_dt.strftime("%Y/%m/%d %H:%M") if not all_day else start_dt.strftime("%Y/%m/%d")
-
-    if end:
-        try:
-            end_dt = datetime.fromisoformat(end)
-            end_str = end_dt.strftime("%Y/%m/%d %H:%M") if not all_day else end_dt.strftime("%Y/%m/%d")
-        except ValueError:
-            end_str = "(無効な終了日時)"
+    # ブラウザのタイムゾーンのオフセット付きで返るので、カレンダーのタイムゾーンに揃えて引く
+    clicked = st.session_state["event_lookup"].get((event.get("id"), event_model.to_key(event["start"])))
+    if clicked is not None:
+        end_str = clicked.end_text
     else:
-        end_str = "(終了時間なし)"
+        clicked = Event.from_dict({"title": event.get("title", ""), "start": event["start"],
+                                   "end": event.get("end") or event["start"], "allDay": event.get("allDay", False)})
+        end_str = clicked.end_text if event.get("end") else "(終了時間なし)"
 
     st.markdown("### 📅 選択された予定")
-    st.write(f"**タイトル**: {title}")
-    st.write(f"**開始**: {start_str}")
+    st.write(f"**タイトル**: {clicked.title}")
+    st.write(f"**開始**: {clicked.start_text}")
     st.write(f"**終了**: {end_str}")
-    st.write(f"**終日**: {'はい' if all_day else 'いいえ'}")
+    st.write(f"**終日**: {'はい' if clicked.all_day else 'いいえ'}")
+
+metrics.observe("ui_rerun_seconds", watch.total())
+metrics.write(min_interval=5)
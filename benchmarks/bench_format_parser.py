@@ -0,0 +1,159 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+FormatEventParser のマイクロベンチマーク
+
+旧実装（呼び出し毎のパターン構築・複数回の re.search・re.sub によるタイトル除去）と
+現在の単一パス実装の1呼び出しあたりのコストを比較する。
+
+    python benchmarks/bench_format_parser.py
+"""
+
+import os
+import re
+import sys
+import timeit
+import warnings
+from datetime import datetime, timedelta
+
+import dateparser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from NLParser import FormatEventParser
+
+
+SAMPLES = [
+    "今日20時から3時間数学の勉強",
+    "明日10時から会議",
+    "2025/6/18 13:00-17:00 定例ミーティング",
+    "2025年6月24日〜2025年6月25日 コンペ",
+    "明後日 友達と外出",
+    "15時 歯医者",
+]
+
+
+def legacy_parse(reference_time, text):
+    """
+    旧実装 FormatEventParser.parse の写し
+
+    元の時刻レンジの文字クラス ``[\\s〜～-から〜ー]`` は ``～-か`` が不正な範囲となり
+    re.error を送出するため、そのパターンのみ意図どおりの形に置き換えている。
+    それ以外（``end <= start`` の補正を含む）は旧実装のまま。
+    """
+    original_text = text.strip()
+    text = original_text
+
+    # 相対表現変換（明日、明後日など）
+    relative_replacements = {
+        '明後日': (reference_time + timedelta(days=2)).strftime('%Y-%m-%d'),
+        '明日': (reference_time + timedelta(days=1)).strftime('%Y-%m-%d'),
+        '今日': reference_time.strftime('%Y-%m-%d'),
+    }
+    for key, val in relative_replacements.items():
+        text = text.replace(key, val)
+
+    # 日時情報の抽出
+    time_range_pattern = r'(\d{1,2})[:時](\d{1,2})?(?:[\s〜～\-ー]|から)+(\d{1,2})[:時](\d{1,2})?'
+    single_time_pattern = r'(\d{1,2})[:時](\d{1,2})?'
+    date_range_pattern = r'(\d{4}[\/年]\d{1,2}[\/月]\d{1,2})[\s〜～-]*(\d{4}[\/年]\d{1,2}[\/月]\d{1,2})'
+    single_date_pattern = r'(\d{4}[\/年]\d{1,2}[\/月]\d{1,2})'
+
+    time_range_match = re.search(time_range_pattern, text)
+    single_time_match = re.search(single_time_pattern, text)
+    date_range_match = re.search(date_range_pattern, text)
+    single_date_match = re.search(single_date_pattern, text)
+
+    has_time = bool(time_range_match or single_time_match)
+    has_date = bool(date_range_match or single_date_match)
+
+    # 日付と時刻の初期値
+    start = reference_time + timedelta(days=1)
+    end = start + timedelta(hours=1)
+    all_day = not has_time
+
+    # 日付レンジ処理
+    if date_range_match:
+        start = dateparser.parse(date_range_match.group(1), settings={'RELATIVE_BASE': reference_time})
+        end = dateparser.parse(date_range_match.group(2), settings={'RELATIVE_BASE': reference_time}) + timedelta(days=1)
+        all_day = True
+
+    # 単一日付＋時刻 or 単独時刻処理
+    elif single_date_match:
+        start = dateparser.parse(single_date_match.group(1), settings={'RELATIVE_BASE': reference_time})
+        if time_range_match:
+            sh, sm, eh, em = time_range_match.groups()
+            start = start.replace(hour=int(sh), minute=int(sm or 0))
+            end = start.replace(hour=int(eh), minute=int(em or 0))
+            if end <= start:
+                end = start + timedelta(hours=1)
+            all_day = False
+        elif single_time_match:
+            hour = int(single_time_match.group(1))
+            minute = int(single_time_match.group(2)) if single_time_match.group(2) else 0
+            start = start.replace(hour=hour, minute=minute)
+            end = start + timedelta(hours=1)
+            all_day = False
+        else:
+            end = start + timedelta(days=1)
+            all_day = True
+
+    # 時刻だけある（"10時から12時"のような場合）
+    elif time_range_match and not single_date_match:
+        start = reference_time
+        sh, sm, eh, em = time_range_match.groups()
+        start = start.replace(hour=int(sh), minute=int(sm or 0))
+        end = start.replace(hour=int(eh), minute=int(em or 0))
+        if end <= start:
+            end = start + timedelta(hours=1)
+        all_day = False
+
+    elif single_time_match and not single_date_match:
+        hour = int(single_time_match.group(1))
+        minute = int(single_time_match.group(2)) if single_time_match.group(2) else 0
+        start = start.replace(hour=hour, minute=minute)
+        end = start + timedelta(hours=1)
+        all_day = False
+
+    # titleの抽出：既知の日時部分を除去した残り
+    cleaned_text = original_text
+    for pattern in [time_range_pattern, single_time_pattern, date_range_pattern, single_date_pattern] + list(relative_replacements.keys()):
+        cleaned_text = re.sub(pattern, '', cleaned_text)
+
+    title_candidates = re.split(r'[\s\-〜～、。]', cleaned_text.strip())
+    title = next((t for t in reversed(title_candidates) if t), "無題の予定")
+
+    return title.strip(), start.isoformat(), end.isoformat(), all_day
+
+
+def bench(func, number):
+    def run():
+        for text in SAMPLES:
+            func(text)
+    seconds = min(timeit.repeat(run, number=number, repeat=5))
+    return seconds / (number * len(SAMPLES)) * 1e6
+
+
+if __name__ == "__main__":
+    reference_time = datetime(2025, 6, 18, 9, 0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        parser = FormatEventParser(reference_time=reference_time)
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    before = bench(lambda t: legacy_parse(reference_time, t), number)
+    after = bench(parser.parse, number)
+    print(f"before: {before:8.2f} us/call")
+    print(f"after : {after:8.2f} us/call")
+    print(f"speedup: x{before / after:.1f}")
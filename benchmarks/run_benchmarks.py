@@ -0,0 +1,348 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+解析器とイベントストレージのベンチマーク / 性能回帰チェック
+
+    # ルールベース系のみ（モデル不要）
+    python benchmarks/run_benchmarks.py --parsers rule,format,hybrid --output results.json
+    # 極小スタブモデルでLLMの処理経路も計測（Qwen3の重み不要）
+    python benchmarks/run_benchmarks.py --parsers rule,hybrid,llm --model stub --constrained
+    # スタブモデルの出力は常に妥当でないので、再試行なしの1回分を測るには --retry-threshold 0
+    python benchmarks/run_benchmarks.py --parsers llm --model stub --retry-threshold 0
+    # 前回の結果と比較し、20%以上悪化していれば終了コード1
+    python benchmarks/run_benchmarks.py --baseline results.json --max-regression 0.2
+
+結果はJSONで出力する（--output 省略時は標準出力）。
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+REFERENCE_TIME = datetime(2025, 6, 18, 9, 0)
+FIELDS = ("action", "title", "start", "end", "all_day", "original_title", "original_start", "rrule")
+
+
+def load_corpus(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+######## 解析器 ########
+
+def make_parsers(names, model=None, constrained=False, workdir=None, retry_threshold=0.7):
+    """名前から (名前, text -> dict の関数) のリストを作る"""
+    from NLParser import FormatEventParser, HybridEventParser, LLMEventParser, RuleEventParser
+
+    llm_parser = None
+    if model and ({"llm", "hybrid"} & set(names)):
+        backend = None
+        if model == "stub":
+            from inference_backends import CPUBackend
+            from stub_model import build_stub_model
+            texts = [item["text"] for item in load_corpus(os.path.join(BENCH_DIR, "corpus.jsonl"))]
+            model = build_stub_model(os.path.join(workdir, "stub_model"), texts)
+            backend = CPUBackend(dtype="fp32", compile=False)
+        llm_parser = LLMEventParser(reference_time=REFERENCE_TIME, model_path=model,
+                                    constrained=constrained, backend=backend, retry_threshold=retry_threshold)
+
+    parsers = []
+    for name in names:
+        if name == "rule":
+            parsers.append((name, RuleEventParser(reference_time=REFERENCE_TIME).parse))
+        elif name == "format":
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                format_parser = FormatEventParser(reference_time=REFERENCE_TIME)
+
+            def parse_format(text, parser=format_parser):
+                title, start, end, all_day = parser.parse(text)
+                return {"action": "add", "title": title, "start": start, "end": end, "all_day": all_day,
+                        "original_title": title, "original_start": start}
+            parsers.append((name, parse_format))
+        elif name == "hybrid":
+            parsers.append((name, HybridEventParser(reference_time=REFERENCE_TIME, llm_parser=llm_parser).parse))
+        elif name == "llm":
+            if llm_parser is None:
+                raise ValueError("llm には --model（モデルのパス、または stub）が必要です")
+            parsers.append((name, llm_parser.parse))
+        else:
+            raise ValueError(f"未知の解析器です: {name}")
+    return parsers
+
+
+def bench_parser(parse, corpus, repeat: int = 1):
+    latencies = []
+    outputs = []
+    failures = 0
+    started = time.perf_counter()
+    for r in range(repeat):
+        for item in corpus:
+            t0 = time.perf_counter()
+            try:
+                output = parse(item["text"])
+            except Exception:
+                output = None
+                failures += 1
+            latencies.append((time.perf_counter() - t0) * 1000)
+            if r == 0:
+                outputs.append(output)
+    elapsed = time.perf_counter() - started
+
+    # メモリは計測のオーバーヘッドがあるので別に1周だけ測る
+    tracemalloc.start()
+    for item in corpus:
+        try:
+            parse(item["text"])
+        except Exception:
+            pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "mean": sum(latencies) / len(latencies),
+        },
+        "throughput_per_s": len(latencies) / elapsed,
+        "peak_python_mb": peak / 2 ** 20,
+        "parse_failures": failures / repeat,
+        "accuracy": field_accuracy(outputs, corpus),
+    }
+
+
+def field_accuracy(outputs, corpus):
+    """期待値が書かれているフィールドごとの正解率（失敗した解析は不正解として数える）"""
+    correct = {field: 0 for field in FIELDS}
+    total = {field: 0 for field in FIELDS}
+    for output, item in zip(outputs, corpus):
+        for field, expected in item["expected"].items():
+            total[field] += 1
+            if output is not None and _normalize(field, output.get(field)) == _normalize(field, expected):
+                correct[field] += 1
+    accuracy = {field: correct[field] / total[field] for field in FIELDS if total[field]}
+    accuracy["overall"] = sum(correct.values()) / max(1, sum(total.values()))
+    return accuracy
+
+
+def _normalize(field, value):
+    if field in ("start", "end", "original_start") and isinstance(value, str):
+        return value[:16]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+######## ストレージ ########
+
+def synthetic_events(n, seed: int = 0):
+    rng = random.Random(seed)
+    base = datetime(2025, 1, 1)
+    events = []
+    for i in range(n):
+        start = base + timedelta(days=rng.randrange(365), hours=rng.randrange(8, 20))
+        all_day = rng.random() < 0.2
+        events.append({
+            "id": f"bench-{i}",
+            "title": f"予定{i}",
+            "start": start.isoformat(),
+            "end": (start + timedelta(days=1) if all_day else start + timedelta(hours=1)).isoformat(),
+            "allDay": all_day,
+        })
+    return events
+
+
+def _timed(func):
+    t0 = time.perf_counter()
+    result = func()
+    return time.perf_counter() - t0, result
+
+
+def bench_storage(sizes, backends, workdir):
+    from event_storage import EventStore, SQLiteEventStore
+
+    results = {}
+    window = (datetime(2025, 6, 1), datetime(2025, 7, 13))
+    for n in sizes:
+        events = synthetic_events(n)
+        for backend in backends:
+            path = os.path.join(workdir, f"{backend}-{n}")
+            os.makedirs(path, exist_ok=True)
+            row = {}
+
+            if backend == "legacy":
+                # 変更前の save_events / load_events（毎回ファイル全体を書き直す）
+                file_path = os.path.join(path, "events.json")
+
+                def legacy_save():
+                    with open(file_path, "w", encoding="utf-8") as f:
+                        json.dump(events, f, ensure_ascii=False, indent=2)
+
+                def legacy_load():
+                    with open(file_path, "r", encoding="utf-8") as f:
+                        return json.load(f)
+
+                row["save_all_s"], _ = _timed(legacy_save)
+                row["load_s"], _ = _timed(legacy_load)
+                row["save_one_change_s"], _ = _timed(legacy_save)
+
+            elif backend == "json":
+                file_path = os.path.join(path, "events.json")
+                with open(file_path, "w", encoding="utf-8") as f:
+                    json.dump(events, f, ensure_ascii=False)
+                row["load_s"], store = _timed(lambda: EventStore(file_path, compact_threshold=10 ** 9))
+                row["load_events_s"], loaded = _timed(store.all)
+                loaded[0]["title"] = "変更後"
+                row["save_one_change_s"], _ = _timed(lambda: store.replace_all(loaded))
+                row["add_one_s"], _ = _timed(lambda: store.add(dict(events[0], id="bench-new")))
+                row["query_range_s"], _ = _timed(lambda: store.query_range(*window))
+                row["compact_s"], _ = _timed(store.compact)
+
+            elif backend == "sqlite":
+                db_path = os.path.join(path, "events.sqlite3")
+                store = SQLiteEventStore(db_path, migrate_from=None)
+                row["save_all_s"], _ = _timed(lambda: store.add_many([dict(e) for e in events]))
+                row["load_s"], store = _timed(lambda: SQLiteEventStore(db_path, migrate_from=None))
+                row["load_events_s"], loaded = _timed(store.all)
+                row["add_one_s"], _ = _timed(lambda: store.add(dict(events[0], id="bench-new")))
+                row["update_one_s"], _ = _timed(lambda: store.update(events[1]["id"], dict(events[1], title="変更後")))
+                row["query_range_s"], _ = _timed(lambda: store.query_range(*window))
+
+            else:
+                raise ValueError(f"未知のストレージです: {backend}")
+
+            results.setdefault(backend, {})[str(n)] = row
+    return results
+
+
+######## 回帰チェック ########
+
+def find_regressions(current, baseline, max_regression):
+    """baseline より max_regression（割合）以上悪化した指標を返す"""
+    regressions = []
+
+    def check(path, now, before, higher_is_better):
+        if not isinstance(now, (int, float)) or not isinstance(before, (int, float)) or before == 0:
+            return
+        change = (before - now) / before if higher_is_better else (now - before) / before
+        if change > max_regression:
+            regressions.append({"metric": path, "baseline": before, "current": now, "change": change})
+
+    for name, now in current.get("parsers", {}).items():
+        before = baseline.get("parsers", {}).get(name)
+        if before is None:
+            continue
+        for q in ("p50", "p95", "p99"):
+            check(f"parsers.{name}.latency_ms.{q}", now["latency_ms"][q], before["latency_ms"][q], False)
+        check(f"parsers.{name}.throughput_per_s", now["throughput_per_s"], before["throughput_per_s"], True)
+        check(f"parsers.{name}.accuracy.overall", now["accuracy"]["overall"], before["accuracy"]["overall"], True)
+
+    for backend, sizes in current.get("storage", {}).items():
+        for n, row in sizes.items():
+            before = baseline.get("storage", {}).get(backend, {}).get(n, {})
+            for metric, value in row.items():
+                check(f"storage.{backend}.{n}.{metric}", value, before.get(metric), False)
+    return regressions
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="NL Calendar benchmarks")
+    arg_parser.add_argument("--parsers", default="rule,format,hybrid", help="comma separated: rule,format,hybrid,llm")
+    arg_parser.add_argument("--model", default=None, help="model path for llm/hybrid, or 'stub' for the offline stub model")
+    arg_parser.add_argument("--constrained", action="store_true", help="use schema-constrained decoding for the LLM")
+    arg_parser.add_argument("--retry-threshold", type=float, default=0.7,
+                            help="LLM results below this confidence are re-parsed (0 disables retries)")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--corpus", default=os.path.join(BENCH_DIR, "corpus.jsonl"))
+    arg_parser.add_argument("--storage", default="legacy,json,sqlite", help="comma separated; empty to skip")
+    arg_parser.add_argument("--storage-sizes", default="1000,10000,100000")
+    arg_parser.add_argument("--output", default=None)
+    arg_parser.add_argument("--baseline", default=None, help="previous results JSON to compare against")
+    arg_parser.add_argument("--max-regression", type=float, default=0.2)
+    args = arg_parser.parse_args(argv)
+
+    sys.path.insert(0, BENCH_DIR)
+    corpus = load_corpus(args.corpus)
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "corpus_size": len(corpus),
+            "repeat": args.repeat,
+            "model": args.model,
+            "constrained": args.constrained,
+        },
+        "parsers": {},
+        "storage": {},
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        parser_names = [n for n in args.parsers.split(",") if n]
+        for name, parse in make_parsers(parser_names, args.model, args.constrained, workdir,
+                                        retry_threshold=args.retry_threshold):
+            results["parsers"][name] = bench_parser(parse, corpus, repeat=args.repeat)
+
+        backends = [b for b in args.storage.split(",") if b]
+        if backends:
+            sizes = [int(n) for n in args.storage_sizes.split(",") if n]
+            results["storage"] = bench_storage(sizes, backends, workdir)
+
+    try:
+        import resource
+        results["meta"]["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        pass
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.max_regression)
+        results["regressions"] = regressions
+        status = 1 if regressions else 0
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ベンチマーク用の極小Qwen3モデル
+
+実際の重みなしで LLMEventParser の処理経路（トークナイズ・prefill・生成・デコード）を
+オフラインで計測するための、文字単位トークナイザとランダム初期化の小さなQwen3を作る。
+出力内容に意味はないので、精度ではなくパイプラインのオーバーヘッドを見るためのもの。
+"""
+
+import os
+import string
+from datetime import datetime
+
+_CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+_SPECIAL_TOKENS = ["<unk>", "<|endoftext|>", "<|im_start|>", "<|im_end|>"]
+
+
+def build_stub_model(path, texts=(), hidden_size: int = 64, num_layers: int = 2, seed: int = 0):
+    """
+    `path` に極小モデルとトークナイザを保存してそのパスを返す（既にあれば再利用する）
+
+    `texts` に含まれる文字と、プロンプト・JSON出力に使われる文字を語彙にする
+    """
+    if os.path.exists(os.path.join(path, "config.json")):
+        return path
+
+    import torch
+    from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM
+
+    from NLParser import LLMEventParser
+
+    # プロンプトのテンプレートを語彙に含めるため、モデルなしでプロンプトを組み立てる
+    template = LLMEventParser.__new__(LLMEventParser)
+    template.reference_time = datetime(2025, 1, 1)
+    prompt_chars = template._prompt_prefix() + template._prompt_suffix("")
+
+    chars = set(prompt_chars) | set("".join(texts))
+    chars |= set(string.ascii_letters + string.digits + string.punctuation + " \n")
+    vocab = {token: i for i, token in enumerate(_SPECIAL_TOKENS)}
+    for c in sorted(chars):
+        vocab.setdefault(c, len(vocab))
+
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(Regex(r"[\s\S]"), behavior="isolated")
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer.add_special_tokens(_SPECIAL_TOKENS)
+    fast_tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer,
+                                             unk_token="<unk>",
+                                             eos_token="<|im_end|>",
+                                             pad_token="<|endoftext|>")
+    fast_tokenizer.chat_template = _CHAT_TEMPLATE
+
+    torch.manual_seed(seed)
+    config = Qwen3Config(vocab_size=len(vocab),
+                         hidden_size=hidden_size,
+                         intermediate_size=hidden_size * 2,
+                         num_hidden_layers=num_layers,
+                         num_attention_heads=4,
+                         num_key_value_heads=2,
+                         head_dim=hidden_size // 4,
+                         max_position_embeddings=4096,
+                         eos_token_id=vocab["<|im_end|>"],
+                         pad_token_id=vocab["<|endoftext|>"])
+    model = Qwen3ForCausalLM(config)
+
+    os.makedirs(path, exist_ok=True)
+    model.save_pretrained(path)
+    fast_tokenizer.save_pretrained(path)
+    return path
@@ -0,0 +1,398 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ICS / CSV の一括インポートと ICS エクスポート
+
+ファイルは1行ずつ読み、イベントは commit_size 件ずつ `add_many` で保存する
+（1回ごとに1トランザクション、JSONストアでは1回の追記）ので、ファイル全体をメモリに載せない。
+CSVで日時の列が空の行は、自然言語の列を batch_size 件ずつパーサの `parse_many` に渡す。
+解析は保存の前に済ませ、ストアのロックを持ったままLLMを動かさない。
+
+    python calendar_io.py import calendar.ics
+    python calendar_io.py import events.csv --llm
+    python calendar_io.py export calendar.ics
+"""
+
+import argparse
+import csv
+import re
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+import event_model
+import recurrence
+
+# CSVの列名（小文字）として受け付ける別名
+CSV_COLUMNS = {
+    "title": ("title", "subject", "summary", "件名", "タイトル"),
+    "start": ("start", "start_time", "dtstart", "開始"),
+    "end": ("end", "end_time", "dtend", "終了"),
+    "all_day": ("all_day", "allday", "終日"),
+    "rrule": ("rrule", "繰り返し"),
+    "text": ("text", "description", "内容", "自然言語"),
+}
+_TRUE_VALUES = {"1", "true", "yes", "y", "はい"}
+# CSVの日時（"/" は "-" に揃えてから試す。月日・時は0埋めなしでもよい: Excel / Googleカレンダーの書き出し）
+_CSV_DATETIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+_DURATION_RE = re.compile(r"([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+_ICS_UNESCAPE_RE = re.compile(r"\\([\\;,nN])")
+_FOLD_WIDTH = 75
+
+
+class ImportReport:
+    """Counts of imported rows and the (line, message) of each row that failed"""
+    def __init__(self):
+        self.imported = 0
+        self.failed = []
+
+    def __repr__(self):
+        return f"ImportReport(imported={self.imported}, failed={len(self.failed)})"
+
+
+def import_file(path, store, parser=None, batch_size: int = 32, fmt=None, commit_size: int = 1000) -> ImportReport:
+    """拡張子（または fmt="ics"/"csv"）で形式を選んでインポートする"""
+    fmt = (fmt or path.rsplit(".", 1)[-1]).lower()
+    if fmt not in ("ics", "csv"):
+        raise ValueError(f"未対応の形式です: {fmt}")
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if fmt == "ics":
+            return import_ics(f, store, commit_size=commit_size)
+        return import_csv(f, store, parser=parser, batch_size=batch_size, commit_size=commit_size)
+
+
+def import_ics(lines, store, commit_size: int = 1000) -> ImportReport:
+    report = ImportReport()
+    report.imported = _add_in_chunks(store, _collect(iter_ics_events(lines), report), commit_size)
+    return report
+
+
+def import_csv(lines, store, parser=None, batch_size: int = 32, commit_size: int = 1000) -> ImportReport:
+    report = ImportReport()
+    report.imported = _add_in_chunks(store, _collect(iter_csv_events(lines, parser, batch_size), report), commit_size)
+    return report
+
+
+def iter_ics_events(lines):
+    """
+    ICS の VEVENT を1件ずつイベント辞書（失敗した場合は (行番号, 例外)）として返す
+
+    折り返し行の連結も1行ずつ行うので、読み込むのは1件分の行だけ
+    """
+    properties = None
+    start_line = 0
+    for line_no, name, params, value in _unfold(lines):
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            properties, start_line = {}, line_no
+        elif name == "END" and value.upper() == "VEVENT" and properties is not None:
+            try:
+                yield _ics_to_event(properties)
+            except (KeyError, ValueError) as e:
+                yield start_line, e
+            properties = None
+        elif properties is not None:
+            if name == "EXDATE":
+                # EXDATE は複数行に分けて書ける
+                properties.setdefault(name, []).append((params, value))
+            else:
+                properties.setdefault(name, (params, value))
+
+
+def iter_csv_events(lines, parser=None, batch_size: int = 32):
+    """
+    CSV の各行をイベント辞書（失敗した場合は (行番号, 例外)）として返す
+
+    start 列がない行は text 列（なければ title 列）を自然言語としてまとめて解析する
+    """
+    reader = csv.DictReader(lines)
+    columns = _csv_columns(reader.fieldnames or [])
+    pending = []
+    for row in reader:
+        line_no = reader.line_num
+        values = {field: (row.get(column) or "").strip() for field, column in columns.items()}
+        if values.get("start"):
+            try:
+                yield _csv_to_event(values)
+            except ValueError as e:
+                yield line_no, e
+            continue
+
+        text = values.get("text") or values.get("title")
+        if not text:
+            yield line_no, ValueError("日時も自然言語の列もありません")
+        elif parser is None:
+            yield line_no, ValueError("自然言語の行を解析するパーサが指定されていません")
+        else:
+            pending.append((line_no, text))
+            if len(pending) >= batch_size:
+                yield from _parse_pending(parser, pending, batch_size)
+                pending = []
+    if pending:
+        yield from _parse_pending(parser, pending, batch_size)
+
+
+def export_ics(events, out, prodid: str = "-//NL Calendar//JA"):
+    """events（イテラブル）を ICS として out に1件ずつ書き出し、件数を返す"""
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    _write_line(out, "BEGIN:VCALENDAR")
+    _write_line(out, "VERSION:2.0")
+    _write_line(out, f"PRODID:{prodid}")
+    # 日時はカレンダーのタイムゾーン名を TZID として付ける（名前がなければ浮動時刻）
+    tzid = getattr(event_model.calendar_timezone(), "key", None)
+    time_prefix = f";TZID={tzid}:" if tzid else ":"
+    count = 0
+    for event in events:
+        all_day = event.get("allDay", False)
+        start = event_model.to_local(event["start"])
+        end = event_model.to_local(event.get("end") or event["start"])
+        _write_line(out, "BEGIN:VEVENT")
+        _write_line(out, f"UID:{event.get('id', count)}@nlcalendar")
+        _write_line(out, f"DTSTAMP:{stamp}")
+        _write_line(out, "SUMMARY:" + _escape(event.get("title", "")))
+        if all_day:
+            _write_line(out, "DTSTART;VALUE=DATE:" + start.strftime("%Y%m%d"))
+            _write_line(out, "DTEND;VALUE=DATE:" + end.strftime("%Y%m%d"))
+        else:
+            _write_line(out, "DTSTART" + time_prefix + _ics_datetime(start))
+            _write_line(out, "DTEND" + time_prefix + _ics_datetime(end))
+        if event.get("rrule"):
+            _write_line(out, "RRULE:" + event["rrule"])
+            if event.get("exdate"):
+                excluded = [event_model.to_local(d) for d in event["exdate"]]
+                if all_day:
+                    _write_line(out, "EXDATE;VALUE=DATE:" + ",".join(d.strftime("%Y%m%d") for d in excluded))
+                else:
+                    _write_line(out, "EXDATE" + time_prefix + ",".join(_ics_datetime(d) for d in excluded))
+        _write_line(out, "END:VEVENT")
+        count += 1
+    _write_line(out, "END:VCALENDAR")
+    return count
+
+
+def export_file(path, store) -> int:
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        return export_ics(store.iter_all(), f)
+
+
+def _add_in_chunks(store, events, commit_size):
+    """
+    events を commit_size 件ずつリストにしてから `add_many` で保存し、件数を返す
+
+    読み込みと解析（LLMを含む）はリストにする間に済ませるので、ストアのロック
+    （スレッドロック・ファイルロック・SQLiteの書き込みトランザクション）は保存の間だけ持つ
+    """
+    imported = 0
+    while True:
+        chunk = list(islice(events, commit_size))
+        if not chunk:
+            return imported
+        imported += store.add_many(chunk)
+
+
+def _collect(items, report):
+    """イベントはそのまま流し、失敗は report に記録する"""
+    for item in items:
+        if isinstance(item, tuple):
+            line_no, error = item
+            report.failed.append((line_no, str(error)))
+        else:
+            yield item
+
+
+def _parse_pending(parser, pending, batch_size):
+    results = parser.parse_many([text for _, text in pending], batch_size=batch_size)
+    for (line_no, _), result in zip(pending, results):
+        if isinstance(result, Exception):
+            yield line_no, result
+        elif result.get("action", "add") != "add":
+            yield line_no, ValueError(f"追加以外の操作はインポートできません: {result.get('action')}")
+        elif result.get("free_slot"):
+            # 空きを探すにはストアを読む必要があり、追加中のストアとは組み合わせられない
+            yield line_no, ValueError("空き時間の指定はインポートできません。日時を指定してください")
+        else:
+            event = {"title": result["title"],
+                     "start": result["start"],
+                     "end": result["end"],
+                     "allDay": result["all_day"]}
+            if result.get("rrule"):
+                event["rrule"] = result["rrule"]
+            yield event
+
+
+def _unfold(lines):
+    """折り返しを連結した論理行を (行番号, 名前, パラメータ, 値) で返す"""
+    current, current_no = None, 0
+    for line_no, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield (current_no, *_split_property(current))
+        current, current_no = line, line_no
+    if current:
+        yield (current_no, *_split_property(current))
+
+
+def _split_property(line):
+    head, _, value = line.partition(":")
+    name, *params = head.split(";")
+    params = dict(p.partition("=")[::2] for p in params)
+    return name.upper(), {k.upper(): v.strip('"') for k, v in params.items()}, value
+
+
+def _ics_to_event(properties):
+    if "DTSTART" not in properties:
+        raise ValueError("DTSTART がありません")
+    start, all_day = _ics_time(*properties["DTSTART"])
+    if "DTEND" in properties:
+        end, _ = _ics_time(*properties["DTEND"])
+    elif "DURATION" in properties:
+        end = start + _ics_duration(properties["DURATION"][1])
+    else:
+        end = start + (timedelta(days=1) if all_day else timedelta(hours=1))
+    event = {"title": _unescape(properties.get("SUMMARY", ({}, ""))[1]) or "無題の予定",
+             "start": start.isoformat(),
+             "end": end.isoformat(),
+             "allDay": all_day}
+    if "RRULE" in properties:
+        recurrence.parse_rrule(properties["RRULE"][1])
+        event["rrule"] = properties["RRULE"][1]
+        excluded = {_ics_time(params, v)[0].isoformat()
+                    for params, value in properties.get("EXDATE", ()) for v in value.split(",") if v}
+        if excluded:
+            event["exdate"] = sorted(excluded)
+    return event
+
+
+def _ics_time(params, value):
+    """(日時, 終日か) を返す。UTC と TZID 付きはカレンダーのタイムゾーンの時刻に変換する"""
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        return datetime.strptime(value[:8], "%Y%m%d"), True
+    moment = datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        moment = moment.replace(tzinfo=timezone.utc)
+    elif "TZID" in params:
+        try:
+            from zoneinfo import ZoneInfo
+            moment = moment.replace(tzinfo=ZoneInfo(params["TZID"]))
+        except Exception:
+            # 不明なタイムゾーンはローカル時刻とみなす
+            pass
+    return event_model.to_local(moment), False
+
+
+def _ics_duration(value):
+    match = _DURATION_RE.match(value.strip())
+    if match is None:
+        raise ValueError(f"DURATION の形式が不正です: {value}")
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0),
+                         hours=int(hours or 0), minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == "-" else duration
+
+
+def _ics_datetime(moment):
+    return moment.strftime("%Y%m%dT%H%M%S")
+
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def _unescape(text):
+    return _ICS_UNESCAPE_RE.sub(lambda m: "\n" if m.group(1) in "nN" else m.group(1), text)
+
+
+def _write_line(out, line):
+    """75オクテットごとに折り返して書き出す（マルチバイト文字の途中では切らない）"""
+    chunk, size = "", 0
+    for c in line:
+        width = len(c.encode("utf-8"))
+        if size + width > _FOLD_WIDTH:
+            out.write(chunk + "\r\n")
+            chunk, size = " ", 1
+        chunk += c
+        size += width
+    out.write(chunk + "\r\n")
+
+
+def _csv_columns(fieldnames):
+    lowered = {name.strip().lower(): name for name in fieldnames if name}
+    columns = {}
+    for field, aliases in CSV_COLUMNS.items():
+        for alias in aliases:
+            if alias in lowered:
+                columns[field] = lowered[alias]
+                break
+    return columns
+
+
+def _csv_datetime(value):
+    text = value.strip().replace("/", "-")
+    try:
+        # オフセット付き（ISO 8601）はカレンダーのタイムゾーンに変換する
+        return event_model.to_local(text)
+    except ValueError:
+        pass
+    for fmt in _CSV_DATETIME_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"日時の形式が不正です: {value}")
+
+
+def _csv_to_event(values):
+    all_day = values.get("all_day", "").lower() in _TRUE_VALUES
+    start = _csv_datetime(values["start"])
+    if values.get("end"):
+        end = _csv_datetime(values["end"])
+    else:
+        end = start + (timedelta(days=1) if all_day else timedelta(hours=1))
+    event = {"title": values.get("title") or values.get("text") or "無題の予定",
+             "start": start.isoformat(),
+             "end": end.isoformat(),
+             "allDay": all_day}
+    if values.get("rrule"):
+        recurrence.parse_rrule(values["rrule"])
+        event["rrule"] = values["rrule"]
+    return event
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="NL Calendar import / export")
+    arg_parser.add_argument("command", choices=("import", "export"))
+    arg_parser.add_argument("path")
+    arg_parser.add_argument("--format", choices=("ics", "csv"), help="default: from the file extension")
+    arg_parser.add_argument("--llm", action="store_true", help="use the LLM for rows the rule parser cannot handle")
+    arg_parser.add_argument("--batch-size", type=int, default=32)
+    args = arg_parser.parse_args()
+
+    from event_storage import get_store
+
+    if args.command == "export":
+        print(f"exported {export_file(args.path, get_store())} events")
+    else:
+        from NLParser import HybridEventParser
+        llm_parser = None
+        if args.llm:
+            from NLParser import LLMEventParser
+            from parse_cache import ParseCache
+            llm_parser = LLMEventParser(cache=ParseCache())
+        report = import_file(args.path, get_store(), parser=HybridEventParser(llm_parser=llm_parser),
+                             batch_size=args.batch_size, fmt=args.format)
+        print(f"imported {report.imported} events, {len(report.failed)} failed")
+        for line_no, message in report.failed:
+            print(f"  line {line_no}: {message}")
@@ -0,0 +1,178 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+予定スキーマに沿ったJSONだけを生成する制約付きデコーディング
+
+`LLMEventParser._build_prompt` の出力形式を、固定部分（キー名や区切り記号）と
+モデルが選ぶ部分（action / title / 日時 / all_day / rrule）の並びとして表す。
+固定部分はモデルを呼ばずにトークンを追加し、次にモデルが選ぶ箇所でまとめてprefillする。
+"""
+
+# (種類, 引数) の並び。"string" の直後は必ず '"' で始まる literal を置くこと
+EVENT_SCHEMA = (
+    ("literal", '{"action": "'),
+    ("enum", ("add", "modify", "delete")),
+    ("literal", '", "title": "'),
+    ("string", None),
+    ("literal", '", "start": "'),
+    ("datetime", None),
+    ("literal", '", "end": "'),
+    ("datetime", None),
+    ("literal", '", "all_day": '),
+    ("enum", ("true", "false")),
+    ("literal", ', "original_title": "'),
+    ("string", None),
+    ("literal", '", "original_start": "'),
+    ("datetime", None),
+    ("literal", '", "rrule": "'),
+    ("string", "allow_empty"),  # 繰り返さない場合は空文字列
+    ("literal", '"}'),
+)
+
+# "yyyy-mm-ddThh:mm:ss" の各桁で許す数字
+_DATETIME_TEMPLATE = "dddd-dd-ddTdd:dd:dd"
+_DATETIME_DIGITS = {
+    5: "01",    # 月の十の位
+    8: "0123",  # 日の十の位
+    11: "012",  # 時の十の位
+    14: "012345",  # 分の十の位
+    17: "012345",  # 秒の十の位
+}
+
+
+class EventSchemaDecoder:
+    """
+    Greedy decoder constrained to `EVENT_SCHEMA`
+
+    Token texts are decoded once per tokenizer and bucketed so that each step only builds
+    a boolean mask over the vocabulary. Literal scaffolding is appended without a forward pass.
+    `forced_tokens` / `model_tokens` count how many tokens were appended each way.
+    """
+    def __init__(self, tokenizer, schema=EVENT_SCHEMA, max_string_tokens: int = 32):
+        self.tokenizer = tokenizer
+        self.schema = schema
+        self.max_string_tokens = max_string_tokens
+
+        self.forced_tokens = 0
+        self.model_tokens = 0
+
+        self._texts = None
+        self._ids_by_text = None
+        self._string_mask = None
+        self._masks = {}
+
+    def generate(self, model, input_ids, past_key_values=None, prefix_len: int = 0) -> str:
+        """
+        スキーマに沿ったJSON文字列を生成する
+
+        `past_key_values` が `input_ids[:prefix_len]` のKVキャッシュであれば、残りだけをprefillする
+        """
+        import torch
+
+        self._prepare(model.config.vocab_size, model.device)
+        generated = []
+        state = {"pending": list(input_ids[prefix_len:]), "past": past_key_values}
+
+        def force(text):
+            ids = self.tokenizer.encode(text, add_special_tokens=False)
+            state["pending"].extend(ids)
+            generated.extend(ids)
+            self.forced_tokens += len(ids)
+
+        def choose(mask):
+            with torch.no_grad():
+                outputs = model(input_ids=torch.tensor([state["pending"]], device=model.device),
+                                past_key_values=state["past"], use_cache=True)
+            state["past"] = outputs.past_key_values
+            logits = outputs.logits[0, -1].masked_fill(~mask, float("-inf"))
+            token = int(torch.argmax(logits))
+            state["pending"] = [token]
+            generated.append(token)
+            self.model_tokens += 1
+            return token
+
+        consumed = 0
+        for i, (kind, arg) in enumerate(self.schema):
+            if kind == "literal":
+                if arg[consumed:]:
+                    force(arg[consumed:])
+                consumed = 0
+
+            elif kind == "enum":
+                typed = ""
+                while True:
+                    remaining = [o for o in arg if o.startswith(typed)]
+                    if typed in arg and len(remaining) == 1:
+                        break
+                    if len(remaining) == 1:
+                        force(remaining[0][len(typed):])
+                        break
+                    candidates = {o[len(typed):j] for o in remaining for j in range(len(typed) + 1, len(o) + 1)}
+                    typed += self._texts[choose(self._mask_for(candidates))]
+
+            elif kind == "datetime":
+                for pos, c in enumerate(_DATETIME_TEMPLATE):
+                    if c == "d":
+                        choose(self._mask_for(_DATETIME_DIGITS.get(pos, "0123456789")))
+                    else:
+                        force(c)
+
+            elif kind == "string":
+                # 文字列は次の literal（'"' で始まる）の先頭部分を含むトークンで閉じる
+                closing = self.schema[i + 1][1]
+                closers = {closing[:j] for j in range(1, len(closing) + 1)}
+                close_mask = self._mask_for(closers)
+                for n in range(self.max_string_tokens):
+                    mask = self._string_mask | close_mask if n > 0 or arg == "allow_empty" else self._string_mask
+                    token = choose(mask)
+                    if self._texts[token] in closers:
+                        consumed = len(self._texts[token])
+                        break
+
+        return self.tokenizer.decode(generated, skip_special_tokens=True)
+
+    def _prepare(self, vocab_size, device):
+        if self._texts is not None:
+            return
+        import torch
+
+        special_ids = set(self.tokenizer.all_special_ids)
+        self._texts = [self.tokenizer.decode([i]) if i < len(self.tokenizer) and i not in special_ids else ""
+                       for i in range(vocab_size)]
+        self._ids_by_text = {}
+        for i, text in enumerate(self._texts):
+            if text:
+                self._ids_by_text.setdefault(text, []).append(i)
+
+        # 文字列の中身として使えるトークン（引用符・バックスラッシュ・制御文字を含まないもの）
+        string_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        for i, text in enumerate(self._texts):
+            if text and '"' not in text and "\\" not in text and not any(ord(c) < 0x20 for c in text):
+                string_mask[i] = True
+        self._string_mask = string_mask.to(device)
+        self._device = device
+
+    def _mask_for(self, texts):
+        key = frozenset(texts)
+        mask = self._masks.get(key)
+        if mask is None:
+            import torch
+            mask = torch.zeros(len(self._texts), dtype=torch.bool)
+            for text in key:
+                for i in self._ids_by_text.get(text, ()):
+                    mask[i] = True
+            mask = mask.to(self._device)
+            self._masks[key] = mask
+        return mask
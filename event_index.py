@@ -0,0 +1,162 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unicodedata
+from collections import defaultdict
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+import recurrence
+from event_model import to_key
+
+
+@lru_cache(maxsize=4096)
+def _normalize_title(title: str) -> str:
+    # str.split() は正規表現の \s と同じく Unicode の空白で区切る
+    return "".join(unicodedata.normalize("NFKC", title or "").split()).lower()
+
+
+def _normalize_start(start: str) -> str:
+    # オフセット付きや秒なしの表記も保存形式に揃える（日付だけなら日付のまま）
+    if len(start) == 10:
+        return start
+    try:
+        return to_key(start)
+    except ValueError:
+        return start
+
+
+class EventIndex:
+    """
+    In-memory lookup index over event ids
+
+    Events are bucketed by (title, start minute) for exact matches and by start day
+    for fuzzy title matching. Only ids and keys are kept, not the event bodies;
+    recurring events additionally keep their rule so that any occurrence can be found.
+    """
+    def __init__(self, events=()):
+        self._entries = {}
+        self._by_key = defaultdict(set)
+        self._by_day = defaultdict(set)
+        self._recurring = {}
+        for event in events:
+            self.put(event)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, event: dict):
+        """イベントを登録する（同じIDがあれば置き換える）"""
+        self.remove(event["id"])
+        self._add(event)
+
+    def load(self, events):
+        """登録済みの内容を捨てて events を登録し直す（読み込み時用）"""
+        self.clear()
+        for event in events:
+            self._add(event)
+
+    def _add(self, event):
+        event_id = event["id"]
+        title = _normalize_title(event["title"])
+        start = _normalize_start(event["start"])
+        minute = start[:16]
+        day = start[:10]
+        self._entries[event_id] = (title, minute, day)
+        self._by_key[(title, minute)].add(event_id)
+        self._by_day[day].add(event_id)
+        if event.get("rrule"):
+            self._recurring[event_id] = {k: event.get(k) for k in ("id", "start", "end", "rrule", "exdate")}
+
+    def remove(self, event_id):
+        entry = self._entries.pop(event_id, None)
+        if entry is None:
+            return
+        title, minute, day = entry
+        self._recurring.pop(event_id, None)
+        self._discard(self._by_key, (title, minute), event_id)
+        self._discard(self._by_day, day, event_id)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_key.clear()
+        self._by_day.clear()
+        self._recurring.clear()
+
+    def on_day(self, day: str):
+        """開始日（"YYYY-MM-DD"）の予定IDを返す"""
+        return sorted(self._by_day.get(day[:10], ()))
+
+    def find(self, title: str, start: str, fuzzy: bool = True, cutoff: float = 0.6, strict: bool = False):
+        """
+        タイトルと開始日時で予定IDを検索する
+
+        (タイトル, 開始時分) が完全一致するものがあればそれらを全て返す。
+        なければ同じ日の予定（その日に回がある繰り返し予定を含む）から
+        タイトルの類似度（同じ時分なら加点）が最も高い1件を返す。
+        start はオフセット付きでもよく（カレンダーのタイムゾーンに揃えて比べる）、日付だけなら時分では絞らない。
+        strict=True（削除など）では、類似度で選ぶのは同じ時分の予定（日付だけならタイトルが一致する予定）に限る。
+        """
+        title = _normalize_title(title)
+        start = _normalize_start(start)
+        minute = start[:16]
+        exact = self._by_key.get((title, minute))
+        if exact:
+            return sorted(exact)
+        if not fuzzy:
+            return []
+
+        candidates = [(event_id, *self._entries[event_id][:2]) for event_id in self._by_day.get(start[:10], ())]
+        candidates += self._recurring_on(start[:10])
+        if strict:
+            if len(minute) == 16:
+                candidates = [c for c in candidates if c[2] == minute]
+            else:
+                candidates = [c for c in candidates if c[1] == title]
+
+        best_id, best_score = None, cutoff
+        for event_id, candidate_title, candidate_minute in candidates:
+            score = SequenceMatcher(None, title, candidate_title).ratio()
+            if title and candidate_title and (title in candidate_title or candidate_title in title):
+                score = max(score, 0.8)
+            if len(minute) == 16 and candidate_minute == minute:
+                score += 0.3
+            if score > best_score or (score == best_score and best_id is None):
+                best_id, best_score = event_id, score
+        return [best_id] if best_id is not None else []
+
+    def _recurring_on(self, day: str):
+        """day に回がある繰り返し予定の (ID, タイトル, その回の開始時分)"""
+        if not self._recurring:
+            return []
+        try:
+            day_start = datetime.fromisoformat(day)
+        except ValueError:
+            return []
+        found = []
+        for event_id, event in self._recurring.items():
+            for occurrence in recurrence.expand(event, day_start, day_start + timedelta(days=1)):
+                if occurrence["start"][:10] == day:
+                    found.append((event_id, self._entries[event_id][0], occurrence["start"][:16]))
+                    break
+        return found
+
+    @staticmethod
+    def _discard(buckets, key, event_id):
+        ids = buckets.get(key)
+        if ids is not None:
+            ids.discard(event_id)
+            if not ids:
+                del buckets[key]
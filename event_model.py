@@ -0,0 +1,130 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+タイムゾーン付きの予定モデルと日時の正規化
+
+保存形式の日時は、カレンダーのタイムゾーン（setup.env の TIMEZONE）での
+"YYYY-MM-DDTHH:MM:SS"（tzinfoなし）の文字列。オフセット付きの値はこのタイムゾーンに変換して揃える。
+"""
+
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "setup.env"))
+
+
+@lru_cache(maxsize=1)
+def calendar_timezone():
+    """カレンダーのタイムゾーン（TIMEZONE、省略時はサーバのローカルタイムゾーン）"""
+    name = os.getenv("TIMEZONE")
+    if name:
+        return ZoneInfo(name.strip())
+    try:
+        import tzlocal
+        return tzlocal.get_localzone()
+    except ImportError:
+        return datetime.now().astimezone().tzinfo
+
+
+def now() -> datetime:
+    """カレンダーのタイムゾーンでの現在時刻（タイムゾーン付き）"""
+    return datetime.now(calendar_timezone()).replace(microsecond=0)
+
+
+def to_local(value) -> datetime:
+    """datetime / ISO文字列を、カレンダーのタイムゾーンでの秒単位の時刻（tzinfoなし）に揃える"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is not None:
+        value = value.astimezone(calendar_timezone()).replace(tzinfo=None)
+    return value.replace(microsecond=0)
+
+
+def to_aware(value) -> datetime:
+    """datetime / ISO文字列をタイムゾーン付きにする（tzinfoなしの値はカレンダーのタイムゾーンの時刻とみなす）"""
+    return to_local(value).replace(tzinfo=calendar_timezone())
+
+
+def to_key(value) -> str:
+    """datetime / ISO文字列を保存・比較用の "YYYY-MM-DDTHH:MM:SS" 形式に揃える"""
+    if isinstance(value, str) and len(value) == 19 and value[10] == "T":
+        # 保存されている日時はほとんどがこの形式なので解析を省く
+        return value
+    return to_local(value).isoformat()
+
+
+@dataclass(frozen=True, slots=True)
+class Event:
+    """
+    Typed, timezone-aware view of a stored event
+
+    Built once per load or change; the serialized datetimes, sort key and display labels
+    are computed at construction so that rendering does not parse any strings.
+    Keys other than the known ones (e.g. "groupId" of expanded occurrences) are kept in `extra`.
+    """
+    id: str
+    title: str
+    start: datetime
+    end: datetime
+    all_day: bool = False
+    rrule: str = ""
+    version: int = 1
+    extra: dict = field(default_factory=dict, compare=False)
+
+    start_iso: str = field(init=False, repr=False, compare=False)
+    end_iso: str = field(init=False, repr=False, compare=False)
+    sort_key: tuple = field(init=False, repr=False, compare=False)
+    label: str = field(init=False, repr=False, compare=False)
+    start_text: str = field(init=False, repr=False, compare=False)
+    end_text: str = field(init=False, repr=False, compare=False)
+
+    _KNOWN_KEYS = ("id", "title", "start", "end", "allDay", "rrule", "version")
+
+    def __post_init__(self):
+        start_iso, end_iso = to_key(self.start), to_key(self.end)
+        fmt = "%Y/%m/%d" if self.all_day else "%Y/%m/%d %H:%M"
+        local_start, local_end = to_local(self.start), to_local(self.end)
+        # frozen なので object.__setattr__ で前計算した値を入れる
+        object.__setattr__(self, "start_iso", start_iso)
+        object.__setattr__(self, "end_iso", end_iso)
+        object.__setattr__(self, "sort_key", (start_iso, end_iso, self.id))
+        object.__setattr__(self, "label", f"{self.title} ({start_iso}～{end_iso})")
+        object.__setattr__(self, "start_text", local_start.strftime(fmt))
+        object.__setattr__(self, "end_text", local_end.strftime(fmt))
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Event":
+        """保存形式の辞書（"start", "end", "allDay" など）から作る"""
+        return cls(id=data.get("id", ""),
+                   title=data.get("title", ""),
+                   start=to_aware(data["start"]),
+                   end=to_aware(data.get("end") or data["start"]),
+                   all_day=bool(data.get("allDay", False)),
+                   rrule=data.get("rrule") or "",
+                   version=data.get("version", 1),
+                   extra={k: v for k, v in data.items() if k not in cls._KNOWN_KEYS})
+
+    def to_dict(self) -> dict:
+        """保存形式の辞書に戻す"""
+        data = {"id": self.id, "title": self.title, "start": self.start_iso, "end": self.end_iso,
+                "allDay": self.all_day, "version": self.version, **self.extra}
+        if self.rrule:
+            data["rrule"] = self.rrule
+        return data
@@ -12,22 +12,884 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import hashlib
 import json
 import os
+import re
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from filelock import FileLock
+
+import metrics
+import recurrence
+from event_index import EventIndex
+from event_model import to_key as _to_key
+from interval_index import IntervalIndex
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 load_dotenv("./setup.env")
 EVENT_FILE_PATH = os.getenv("EVENT_FILE_PATH")
 assert EVENT_FILE_PATH != None
+# 設定されていればSQLiteバックエンドを使う（初回起動時にEVENT_FILE_PATHから移行）
+EVENT_DB_PATH = os.getenv("EVENT_DB_PATH")
+DEFAULT_CALENDAR = "default"
+
+
+def _end_key(event) -> str:
+    """範囲検索に使う終了日時（繰り返し予定は最後の回の終了日時）"""
+    if event.get("rrule"):
+        return recurrence.series_end(event)
+    return _to_key(event.get("end") or event["start"])
+
+
+# この長さ以下の予定は、範囲検索で開始日時を [範囲の開始 - _SHORT_SPAN, 範囲の終了) に絞って探す
+_SHORT_SPAN = timedelta(days=1)
+
+# SQLiteのイベントテーブル（IDはカレンダーごとに一意）
+# long_span は繰り返し予定と _SHORT_SPAN より長い予定（開始日時で絞れないので別に探す）
+_EVENTS_TABLE = (
+    "CREATE TABLE {name} ("
+    f" calendar TEXT NOT NULL DEFAULT '{DEFAULT_CALENDAR}',"
+    " id TEXT NOT NULL,"
+    " start TEXT NOT NULL,"
+    " end TEXT NOT NULL,"
+    " version INTEGER NOT NULL DEFAULT 1,"
+    " long_span INTEGER NOT NULL DEFAULT 0,"
+    " data TEXT NOT NULL,"
+    " PRIMARY KEY (calendar, id))"
+)
+
+
+def _long_span(event, start_key, end_key) -> int:
+    if event.get("rrule"):
+        return 1
+    if start_key[:10] == end_key[:10]:
+        return 0
+    return int(datetime.fromisoformat(end_key) - datetime.fromisoformat(start_key) > _SHORT_SPAN)
+
+
+def _overlaps(event, start_key, end_key) -> bool:
+    """event が [start_key, end_key) と重なるか（長さ0の予定は開始日時が範囲内なら重なるとみなす）"""
+    start = _to_key(event["start"])
+    return start < end_key and (_end_key(event) > start_key or start >= start_key)
+
+
+def _timed(op):
+    """メソッドの処理時間を storage_seconds{backend, op} に記録する"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with metrics.timer("storage_seconds", backend=self.backend, op=op):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class VersionConflict(Exception):
+    """Raised when an update / delete was based on an outdated version of the event"""
+    def __init__(self, event_id, expected, actual=None):
+        super().__init__(f"予定 {event_id} は他の操作で更新されています（version {expected} → {actual}）")
+        self.event_id = event_id
+        self.expected = expected
+        self.actual = actual
+
+
+def _file_stat(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _without_version(event):
+    return {k: v for k, v in event.items() if k != "version"}
+
+
+class EventStore:
+    """
+    Append-only event store
+
+    The snapshot (`path`, JSON) is replayed together with an operation log (`path + ".log"`, JSON lines).
+    Every mutation appends one line to the log; the log is folded into a new snapshot
+    (written to a temporary file and atomically renamed) once it grows past `compact_threshold` operations.
+
+    Several processes may share the files: every call holds an inter-process lock (`path + ".lock"`)
+    and first applies the log lines other writers appended since the previous call.
+    Operations carry a sequence number (see `changes_since`) and events a "version" that
+    `update` / `delete` can check (`VersionConflict`).
+    """
+    backend = "json"
+
+    def __init__(self, path=EVENT_FILE_PATH, compact_threshold: int = 1000):
+        self.path = path
+        self.log_path = path + ".log"
+        self.compact_threshold = compact_threshold
+
+        self.index = EventIndex()
+        self.intervals = IntervalIndex()
+        self._events = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file_lock = FileLock(path + ".lock")
+        with self._lock, self._file_lock:
+            self._replay()
+
+    def all(self):
+        """全イベントのリストを返す（各要素は "id" と "version" を持つ）"""
+        with self._synced():
+            return [dict(e) for e in self._events.values()]
+
+    def get(self, event_id):
+        with self._synced():
+            event = self._events.get(event_id)
+            return dict(event) if event is not None else None
+
+    def iter_all(self):
+        """全イベントを順に返す（エクスポート用）"""
+        with self._synced():
+            events = list(self._events.values())
+        for event in events:
+            yield dict(event)
+
+    @_timed("query_range")
+    def query_range(self, start, end, expand: bool = True):
+        """
+        [start, end) と重なるイベントを返す
+
+        expand=True なら繰り返し予定はこの範囲の各回に展開する
+        """
+        start_key, end_key = _to_key(start), _to_key(end)
+        with self._synced():
+            events = [dict(e) for e in self._events.values() if _overlaps(e, start_key, end_key)]
+        return recurrence.expand_events(events, start, end) if expand else events
+
+    def find(self, title, start, fuzzy: bool = True, strict: bool = False):
+        """タイトルと開始日時で予定を検索する（`EventIndex.find` を参照）"""
+        with self._synced():
+            return [dict(self._events[i]) for i in self.index.find(title, start, fuzzy=fuzzy, strict=strict)]
+
+    def conflicts(self, event: dict, exclude_id=None, horizon=timedelta(days=90)):
+        """event と時間が重なる予定を返す（`find_conflicts` を参照）"""
+        with self._synced():
+            return find_conflicts(self.intervals, self._events.get, event, exclude_id, horizon)
+
+    def first_free_slot(self, start, end, duration: timedelta):
+        """[start, end) で最初に duration だけ空いている (開始, 終了)（なければ None）"""
+        with self._synced():
+            return self.intervals.first_free_slot(start, end, duration)
+
+    def current_seq(self) -> int:
+        with self._synced():
+            return self._seq
+
+    def changes_since(self, seq: int):
+        """
+        seq より後の変更を (現在の seq, 追加・更新されたイベント, 削除されたID) で返す
+
+        seq までさかのぼれない場合（他のプロセスがログを畳み込んだ後など）は None を返すので、全件を読み直すこと
+        """
+        with self._synced():
+            if seq < self._base_seq:
+                return None
+            changed, deleted = [], []
+            for event_id in reversed(self._changed):
+                if self._changed[event_id] <= seq:
+                    break
+                if event_id in self._events:
+                    changed.append(dict(self._events[event_id]))
+                else:
+                    deleted.append(event_id)
+            return self._seq, changed, deleted
+
+    @_timed("add")
+    def add(self, event: dict) -> str:
+        """イベントを追加してIDを返す（"id" がなければ採番して event に書き込む）"""
+        event.setdefault("id", uuid.uuid4().hex)
+        event["version"] = 1
+        with self._synced():
+            self._write([self._put(event)])
+        return event["id"]
+
+    @_timed("add_many")
+    def add_many(self, events) -> int:
+        """
+        複数のイベントを追加して件数を返す
+
+        events はイテラブル（ジェネレータ可）で、ログへの追記は1回の書き込みとfsyncにまとめる
+        """
+        def ops():
+            for event in events:
+                event.setdefault("id", uuid.uuid4().hex)
+                event["version"] = 1
+                yield self._put(event)
+
+        with self._synced():
+            return self._write(ops())
+
+    @_timed("update")
+    def update(self, event_id, event: dict, expected_version=None):
+        """
+        イベントを置き換える
+
+        expected_version を渡すと、現在の version と異なる場合に VersionConflict を送出する
+        """
+        with self._synced():
+            current = self._events.get(event_id)
+            if current is None:
+                raise KeyError(event_id)
+            self._check_version(current, expected_version)
+            event["id"] = event_id
+            event["version"] = current.get("version", 1) + 1
+            self._write([self._put(event)])
+
+    @_timed("delete")
+    def delete(self, event_id, expected_version=None):
+        with self._synced():
+            current = self._events.get(event_id)
+            if current is None:
+                return
+            self._check_version(current, expected_version)
+            self._write([self._delete(event_id)])
+
+    @_timed("replace_all")
+    def replace_all(self, events):
+        """
+        イベント一覧を丸ごと置き換える
+
+        現在の内容との差分だけをログに追記する
+        """
+        def ops():
+            seen = set()
+            for event in events:
+                event.setdefault("id", uuid.uuid4().hex)
+                seen.add(event["id"])
+                current = self._events.get(event["id"])
+                if current is None:
+                    event["version"] = 1
+                elif current == event:
+                    continue
+                elif _without_version(current) != _without_version(event):
+                    event["version"] = current.get("version", 1) + 1
+                else:
+                    continue
+                yield self._put(event)
+            for event_id in [i for i in self._events if i not in seen]:
+                yield self._delete(event_id)
+
+        with self._synced():
+            self._write(ops())
+
+    def compact(self):
+        """ログをスナップショットに畳み込む"""
+        with self._synced():
+            self._compact()
+
+    @contextmanager
+    def _synced(self):
+        # スレッド間・プロセス間の排他を取り、他の書き込みを反映してから処理する
+        with self._lock, self._file_lock:
+            self._refresh()
+            yield
+
+    def _check_version(self, current, expected_version):
+        if expected_version is not None and current.get("version", 1) != expected_version:
+            raise VersionConflict(current["id"], expected_version, current.get("version", 1))
+
+    def _put(self, event):
+        self._seq += 1
+        self._events[event["id"]] = dict(event)
+        self.index.put(event)
+        self.intervals.put(event)
+        self._mark_changed(event["id"])
+        return {"op": "put", "seq": self._seq, "id": event["id"], "event": event}
+
+    def _delete(self, event_id):
+        self._seq += 1
+        del self._events[event_id]
+        self.index.remove(event_id)
+        self.intervals.remove(event_id)
+        self._mark_changed(event_id)
+        return {"op": "delete", "seq": self._seq, "id": event_id}
+
+    def _mark_changed(self, event_id):
+        self._changed[event_id] = self._seq
+        self._changed.move_to_end(event_id)
+
+    @_timed("append_log")
+    def _write(self, ops) -> int:
+        count = 0
+        with open(self.log_path, "ab") as f:
+            for op in ops:
+                line = (json.dumps(op, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                self._log_offset += len(line)
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_ops += count
+        if self._log_ops >= self.compact_threshold:
+            self._compact()
+        return count
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": self._seq, "events": list(self._events.values())}, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # ログの操作はID単位で冪等なので、ここで落ちても再生結果は変わらない
+        open(self.log_path, "w", encoding="utf-8").close()
+        self._snapshot_stat = _file_stat(self.path)
+        self._log_offset = 0
+        self._log_ops = 0
+
+    def _refresh(self):
+        """他のプロセスが追記したログだけを反映する（スナップショットが作り直されていれば読み直す）"""
+        if _file_stat(self.path) != self._snapshot_stat:
+            self._replay()
+            return
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        if log_size < self._log_offset:
+            self._replay()
+        elif log_size > self._log_offset and not self._read_log():
+            self._compact()
+
+    @_timed("load")
+    def _replay(self):
+        self._events = {}
+        # ID ごとの最後の変更の seq（変更順）
+        self._changed = OrderedDict()
+        self._seq = 0
+        self._log_offset = 0
+        self._log_ops = 0
+
+        needs_compact = False
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            # 旧形式のファイルはイベントのリストだけ
+            if isinstance(snapshot, list):
+                snapshot = {"seq": 0, "events": snapshot}
+            self._seq = snapshot["seq"]
+            for event in snapshot["events"]:
+                if "id" not in event:
+                    # 旧形式のファイルにはIDがないので採番して書き戻す
+                    event["id"] = uuid.uuid4().hex
+                    needs_compact = True
+                event.setdefault("version", 1)
+                self._events[event["id"]] = event
+        self.index.load(self._events.values())
+        self.intervals.load(self._events.values())
+        self._snapshot_stat = _file_stat(self.path)
+        self._base_seq = self._seq
+
+        if os.path.exists(self.log_path) and not self._read_log():
+            needs_compact = True
+        if needs_compact:
+            self._compact()
+
+    def _read_log(self) -> bool:
+        """ログの未読部分を反映する（壊れた行があれば False）"""
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_offset)
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError
+                    op = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた末尾行は捨てる
+                    return False
+                self._seq = op.get("seq", self._seq + 1)
+                if op["op"] == "put":
+                    op["event"].setdefault("version", 1)
+                    self._events[op["id"]] = op["event"]
+                    self.index.put(op["event"])
+                    self.intervals.put(op["event"])
+                elif op["op"] == "delete":
+                    self._events.pop(op["id"], None)
+                    self.index.remove(op["id"])
+                    self.intervals.remove(op["id"])
+                self._mark_changed(op["id"])
+                self._log_offset += len(line)
+                self._log_ops += 1
+        return True
+
+
+class SQLiteEventStore:
+    """
+    SQLite-backed event store
+
+    Same interface as `EventStore`; events keep their dict shape (stored as JSON)
+    while start/end are mirrored into indexed columns for `query_range`.
+    Calendars share one database through the `calendar` column (ids are unique per calendar). Every write is recorded in the
+    `changes` table for `changes_since`, and version checks are part of the UPDATE / DELETE itself.
+    """
+    backend = "sqlite"
+    # changes テーブルに残す件数（これより古い seq からは changes_since で追えない）
+    changes_kept = 10000
+
+    def __init__(self, path=EVENT_DB_PATH, migrate_from=EVENT_FILE_PATH, calendar=DEFAULT_CALENDAR):
+        self.path = path
+        self.calendar = calendar
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # 他のプロセスが書き込み中なら最大30秒待つ
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_EVENTS_TABLE.format(name="IF NOT EXISTS events"))
+        # カレンダー・バージョン導入前のデータベースには列を追加する
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(events)")}
+        if "calendar" not in columns:
+            self._conn.execute(f"ALTER TABLE events ADD COLUMN calendar TEXT NOT NULL DEFAULT '{DEFAULT_CALENDAR}'")
+        if "version" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE events ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+                # 読み出し側は data の "version" で楽観的排他を行うので、列と同じ値を書き込んでおく
+                self._conn.execute("UPDATE events SET data = json_set(data, '$.version', version)")
+        if "long_span" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE events ADD COLUMN long_span INTEGER NOT NULL DEFAULT 0")
+                self._conn.execute(
+                    "UPDATE events SET long_span = 1"
+                    " WHERE COALESCE(json_extract(data, '$.rrule'), '') != ''"
+                    " OR julianday(end) - julianday(start) > ?",
+                    (_SHORT_SPAN / timedelta(days=1),)
+                )
+        # 主キーが id だけの古いテーブルでは、別のカレンダーに同じIDを追加すると元の行が置き換わるので作り直す
+        if self._primary_key() != ["calendar", "id"]:
+            self._migrate_primary_key()
+        self._conn.execute("DROP INDEX IF EXISTS events_start_end")
+        self._conn.execute("DROP INDEX IF EXISTS events_end")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_calendar_start_end ON events(calendar, start, end)")
+        self._conn.execute("DROP INDEX IF EXISTS events_calendar_end")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_calendar_long ON events(calendar, start) WHERE long_span = 1")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " calendar TEXT NOT NULL,"
+            " event_id TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS changes_calendar_seq ON changes(calendar, seq)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+        self.index = EventIndex()
+        self.intervals = IntervalIndex()
+        self._load_index()
+        if migrate_from:
+            self._migrate(migrate_from)
+
+    def all(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM events WHERE calendar = ? ORDER BY start",
+                                      (self.calendar,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def get(self, event_id):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM events WHERE id = ? AND calendar = ?",
+                                     (event_id, self.calendar)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def iter_all(self, page_size: int = 500):
+        """全イベントをID順に page_size 件ずつ読みながら返す（エクスポート用）"""
+        last_id = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, data FROM events WHERE calendar = ? AND id > ? ORDER BY id LIMIT ?",
+                    (self.calendar, last_id, page_size)
+                ).fetchall()
+            if not rows:
+                return
+            for _, data in rows:
+                yield json.loads(data)
+            last_id = rows[-1][0]
+
+    @_timed("query_range")
+    def query_range(self, start, end, expand: bool = True):
+        """
+        [start, end) と重なるイベントを返す
+
+        expand=True なら繰り返し予定はこの範囲の各回に展開する
+        """
+        start_key, end_key = _to_key(start), _to_key(end)
+        # 短い予定は開始日時の範囲を両側で絞り（索引で O(log N + k)）、長い予定・繰り返し予定は別に探す
+        lower_key = (recurrence.to_datetime(start) - _SHORT_SPAN).isoformat()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data, start FROM events WHERE calendar = ? AND long_span = 0"
+                " AND start >= ? AND start < ? AND (end > ? OR start >= ?)"
+                " UNION ALL"
+                " SELECT data, start FROM events WHERE calendar = ? AND long_span = 1"
+                " AND start < ? AND (end > ? OR start >= ?)"
+                " ORDER BY start",
+                (self.calendar, lower_key, end_key, start_key, start_key,
+                 self.calendar, end_key, start_key, start_key)
+            ).fetchall()
+        events = [json.loads(r[0]) for r in rows]
+        return recurrence.expand_events(events, start, end) if expand else events
+
+    def find(self, title, start, fuzzy: bool = True, strict: bool = False):
+        """タイトルと開始日時で予定を検索する（`EventIndex.find` を参照）"""
+        with self._lock:
+            self._sync_index()
+            ids = self.index.find(title, start, fuzzy=fuzzy, strict=strict)
+            rows = [self._conn.execute("SELECT data FROM events WHERE id = ? AND calendar = ?",
+                                       (i, self.calendar)).fetchone() for i in ids]
+        return [json.loads(r[0]) for r in rows if r is not None]
+
+    def conflicts(self, event: dict, exclude_id=None, horizon=timedelta(days=90)):
+        """event と時間が重なる予定を返す（`find_conflicts` を参照）"""
+        with self._lock:
+            self._sync_index()
+            return find_conflicts(self.intervals, self._get, event, exclude_id, horizon)
+
+    def first_free_slot(self, start, end, duration: timedelta):
+        """[start, end) で最初に duration だけ空いている (開始, 終了)（なければ None）"""
+        with self._lock:
+            self._sync_index()
+            return self.intervals.first_free_slot(start, end, duration)
+
+    def current_seq(self) -> int:
+        with self._lock:
+            return self._current_seq()
+
+    def changes_since(self, seq: int):
+        """
+        seq より後の変更を (現在の seq, 追加・更新されたイベント, 削除されたID) で返す
+
+        seq までさかのぼれない場合は None を返すので、全件を読み直すこと
+        """
+        with self._lock:
+            changes = self._changes(seq)
+        if changes is None:
+            return None
+        current, rows = changes
+        changed = [json.loads(data) for _, data in rows if data is not None]
+        deleted = [event_id for event_id, data in rows if data is None]
+        return current, changed, deleted
+
+    @_timed("add")
+    def add(self, event: dict) -> str:
+        event.setdefault("id", uuid.uuid4().hex)
+        event["version"] = 1
+        with self._lock, self._conn:
+            self._put(event)
+        return event["id"]
+
+    @_timed("add_many")
+    def add_many(self, events) -> int:
+        """複数のイベント（ジェネレータ可）を1トランザクションで追加して件数を返す"""
+        count = 0
+        with self._lock, self._conn:
+            for event in events:
+                event.setdefault("id", uuid.uuid4().hex)
+                event["version"] = 1
+                self._put(event)
+                count += 1
+        return count
+
+    @_timed("update")
+    def update(self, event_id, event: dict, expected_version=None):
+        """
+        イベントを置き換える
+
+        expected_version を渡すと、現在の version と異なる場合に VersionConflict を送出する
+        """
+        event["id"] = event_id
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT version FROM events WHERE id = ? AND calendar = ?",
+                                     (event_id, self.calendar)).fetchone()
+            if row is None:
+                raise KeyError(event_id)
+            current = row[0]
+            if expected_version is not None and current != expected_version:
+                raise VersionConflict(event_id, expected_version, current)
+            event["version"] = current + 1
+            start, end = _to_key(event["start"]), _end_key(event)
+            # 読んでから書くまでの間に他のプロセスが更新していれば0行になる
+            cursor = self._conn.execute(
+                "UPDATE events SET start = ?, end = ?, version = ?, long_span = ?, data = ?"
+                " WHERE id = ? AND calendar = ? AND version = ?",
+                (start, end, event["version"], _long_span(event, start, end), json.dumps(event, ensure_ascii=False),
+                 event_id, self.calendar, current)
+            )
+            if cursor.rowcount == 0:
+                raise VersionConflict(event_id, current)
+            self._record_change(event_id)
+            self.index.put(event)
+            self.intervals.put(event)
+
+    @_timed("delete")
+    def delete(self, event_id, expected_version=None):
+        with self._lock, self._conn:
+            if expected_version is None:
+                cursor = self._conn.execute("DELETE FROM events WHERE id = ? AND calendar = ?",
+                                            (event_id, self.calendar))
+            else:
+                cursor = self._conn.execute("DELETE FROM events WHERE id = ? AND calendar = ? AND version = ?",
+                                            (event_id, self.calendar, expected_version))
+                if cursor.rowcount == 0:
+                    row = self._conn.execute("SELECT version FROM events WHERE id = ? AND calendar = ?",
+                                             (event_id, self.calendar)).fetchone()
+                    if row is not None:
+                        raise VersionConflict(event_id, expected_version, row[0])
+            if cursor.rowcount:
+                self._record_change(event_id)
+            self.index.remove(event_id)
+            self.intervals.remove(event_id)
+
+    @_timed("replace_all")
+    def replace_all(self, events):
+        with self._lock, self._conn:
+            current = {event_id: (version, data) for event_id, version, data in self._conn.execute(
+                "SELECT id, version, data FROM events WHERE calendar = ?", (self.calendar,))}
+            seen = set()
+            for event in events:
+                event.setdefault("id", uuid.uuid4().hex)
+                seen.add(event["id"])
+                if event["id"] not in current:
+                    event["version"] = 1
+                else:
+                    version, data = current[event["id"]]
+                    if _without_version(json.loads(data)) == _without_version(event):
+                        continue
+                    event["version"] = version + 1
+                self._put(event)
+            for event_id in current.keys() - seen:
+                self._conn.execute("DELETE FROM events WHERE id = ? AND calendar = ?", (event_id, self.calendar))
+                self._record_change(event_id)
+                self.index.remove(event_id)
+                self.intervals.remove(event_id)
+
+    def _put(self, event):
+        start = _to_key(event["start"])
+        end = _end_key(event)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO events (id, calendar, start, end, version, long_span, data)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (event["id"], self.calendar, start, end, event.get("version", 1), _long_span(event, start, end),
+             json.dumps(event, ensure_ascii=False))
+        )
+        self._record_change(event["id"])
+        self.index.put(event)
+        self.intervals.put(event)
+
+    def _primary_key(self):
+        # table_info の6列目は主キー内の位置（主キーでなければ0）
+        rows = [row for row in self._conn.execute("PRAGMA table_info(events)") if row[5]]
+        return [row[1] for row in sorted(rows, key=lambda row: row[5])]
+
+    def _migrate_primary_key(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 他のプロセスが先に作り直していれば何もしない
+            if self._primary_key() != ["calendar", "id"]:
+                self._conn.execute(_EVENTS_TABLE.format(name="events_new"))
+                self._conn.execute("INSERT INTO events_new (calendar, id, start, end, version, long_span, data)"
+                                   " SELECT calendar, id, start, end, version, long_span,"
+                                   " json_set(data, '$.version', version) FROM events")
+                self._conn.execute("DROP TABLE events")
+                self._conn.execute("ALTER TABLE events_new RENAME TO events")
+            self._conn.commit()
+        except BaseException:
+            self._conn.rollback()
+            raise
+
+    def _get(self, event_id):
+        row = self._conn.execute("SELECT data FROM events WHERE id = ? AND calendar = ?",
+                                 (event_id, self.calendar)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _record_change(self, event_id):
+        cursor = self._conn.execute("INSERT INTO changes (calendar, event_id) VALUES (?, ?)", (self.calendar, event_id))
+        self._conn.execute("DELETE FROM changes WHERE seq <= ?", (cursor.lastrowid - self.changes_kept,))
+
+    def _current_seq(self):
+        return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def _changes(self, seq):
+        """(現在の seq, [(ID, data または削除なら None)]) を返す（さかのぼれなければ None）"""
+        current = self._current_seq()
+        oldest = self._conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+        if oldest is not None and seq < oldest - 1:
+            return None
+        rows = self._conn.execute(
+            "SELECT c.event_id, e.data FROM changes c"
+            " LEFT JOIN events e ON e.id = c.event_id AND e.calendar = c.calendar"
+            " WHERE c.calendar = ? AND c.seq > ? AND c.seq <= ?"
+            " GROUP BY c.event_id",
+            (self.calendar, seq, current)
+        ).fetchall()
+        return current, rows
+
+    def _load_index(self):
+        self._index_seq = self._current_seq()
+        events = []
+        # 開始・終了日時は列の値を使う（繰り返し予定の end 列は最後の回の終了日時なので、長い予定だけ JSON から読む）
+        # 繰り返しの規則・除外日も、繰り返し予定を含む長い予定だけ読む
+        for event_id, start, end, title, rrule, all_day, exdate in self._conn.execute(
+                "SELECT id, start, CASE WHEN long_span = 1 THEN json_extract(data, '$.end') ELSE end END,"
+                " json_extract(data, '$.title'), CASE WHEN long_span = 1 THEN json_extract(data, '$.rrule') END,"
+                " json_extract(data, '$.allDay'), CASE WHEN long_span = 1 THEN json_extract(data, '$.exdate') END"
+                " FROM events WHERE calendar = ?",
+                (self.calendar,)):
+            event = {"id": event_id, "title": title, "start": start, "end": end, "rrule": rrule, "allDay": all_day}
+            if exdate:
+                # 配列は JSON の文字列で返る
+                event["exdate"] = json.loads(exdate)
+            events.append(event)
+        self.index.load(events)
+        self.intervals.load(events)
+
+    def _sync_index(self):
+        # 他のプロセス（や同じカレンダーの別インスタンス）の書き込みを索引に反映する
+        changes = self._changes(self._index_seq)
+        if changes is None:
+            self._load_index()
+            return
+        self._index_seq, rows = changes
+        for event_id, data in rows:
+            if data is None:
+                self.index.remove(event_id)
+                self.intervals.remove(event_id)
+            else:
+                event = json.loads(data)
+                self.index.put(event)
+                self.intervals.put(event)
+
+    @_timed("migrate")
+    def _migrate(self, json_path):
+        # 移行は一度だけ（移行済みフラグで判定）
+        if self._conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone() is not None:
+            return
+        events = EventStore(json_path).all() if os.path.exists(json_path) else []
+        with self._lock, self._conn:
+            for event in events:
+                event.setdefault("version", 1)
+                self._put(event)
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (json_path,))
+
+
+def find_conflicts(intervals, get_event, event: dict, exclude_id=None, horizon=timedelta(days=90)):
+    """
+    intervals の中で event と時間が重なる予定を、重なる回の日時に置き換えた辞書として開始日時順に返す
+
+    繰り返し予定の event は最初の回から horizon 先までの各回で調べる。終日予定どうし以外は終日予定を無視する
+    """
+    if event.get("rrule"):
+        start = recurrence.to_datetime(event["start"])
+        occurrences = [(recurrence.to_datetime(o["start"]), recurrence.to_datetime(o["end"]))
+                       for o in recurrence.expand(event, start, start + horizon)]
+    else:
+        occurrences = [(recurrence.to_datetime(event["start"]), recurrence.to_datetime(event.get("end") or event["start"]))]
+
+    found = {}
+    for start, end in occurrences:
+        for event_id, s, e in intervals.overlapping(start, end, include_all_day=bool(event.get("allDay"))):
+            if event_id == exclude_id or event_id == event.get("id") or (event_id, s) in found:
+                continue
+            other = get_event(event_id)
+            if other is not None:
+                found[(event_id, s)] = {**other, "start": s.isoformat(), "end": e.isoformat()}
+    return sorted(found.values(), key=lambda e: e["start"])
+
+
+def resolve_free_slot(result: dict, store, not_before=None, step=timedelta(minutes=15)) -> dict:
+    """
+    解析結果の "free_slot"（探す範囲と長さ）を、store の予定と重ならない最初の時間帯の start / end に置き換えて返す
+
+    not_before（現在時刻など）より前は探さない（step 単位に切り上げる）。空きがなければ ValueError
+    """
+    request = result.get("free_slot")
+    if not request:
+        return result
+    window_start = recurrence.to_datetime(request["window_start"])
+    if not_before is not None:
+        not_before = recurrence.to_datetime(not_before)
+        remainder = (not_before - datetime.min) % step
+        window_start = max(window_start, not_before + (step - remainder if remainder else timedelta(0)))
+    duration = timedelta(minutes=request["duration_minutes"])
+    slot = store.first_free_slot(window_start, request["window_end"], duration)
+    if slot is None:
+        raise ValueError(f"{request['window_start'][:10]} の {request['window_start'][11:16]}～"
+                         f"{request['window_end'][11:16]} に{request['duration_minutes']}分の空き時間がありません")
+    resolved = {k: v for k, v in result.items() if k != "free_slot"}
+    resolved["start"], resolved["end"] = slot[0].isoformat(), slot[1].isoformat()
+    resolved["original_start"] = resolved["start"]
+    return resolved
+
+
+def delete_occurrence(store, series: dict, occurrence_start, expected_version=None):
+    """
+    繰り返し予定 series（保存されている辞書）の occurrence_start の回だけを削除する
+
+    回は "exdate" に加えて除き、残りの回がなくなれば系列ごと削除する
+    """
+    updated = recurrence.exclude_occurrence(series, occurrence_start)
+    if recurrence.has_occurrences(updated):
+        store.update(series["id"], updated, expected_version=expected_version)
+    else:
+        store.delete(series["id"], expected_version=expected_version)
+
+
+def calendar_name(user=None, calendar=DEFAULT_CALENDAR) -> str:
+    """ユーザーごとのカレンダー名（"user/calendar"）"""
+    return f"{user}/{calendar}" if user else calendar
+
+
+def calendar_path(calendar=DEFAULT_CALENDAR) -> str:
+    """JSONストアでのカレンダーのファイルパス（既定のカレンダーは EVENT_FILE_PATH）"""
+    if calendar == DEFAULT_CALENDAR:
+        return EVENT_FILE_PATH
+    safe = re.sub(r"[^\w\-]", "_", calendar)
+    digest = hashlib.sha1(calendar.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(os.path.dirname(EVENT_FILE_PATH), "calendars", f"{safe}-{digest}.json")
+
+
+def apply_changes(events, changes, start, end):
+    """
+    `changes_since` の結果を、[start, end) で読み込んだイベント一覧に反映した新しい一覧を返す
+
+    変更のあったIDの予定（繰り返し予定は全ての回）を入れ替える
+    """
+    _, changed, deleted = changes
+    stale = set(deleted) | {e["id"] for e in changed}
+    start_key, end_key = _to_key(start), _to_key(end)
+    visible = [e for e in changed if _overlaps(e, start_key, end_key)]
+    events = [e for e in events if e["id"] not in stale] + recurrence.expand_events(visible, start, end)
+    return sorted(events, key=lambda e: _to_key(e["start"]))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(calendar=DEFAULT_CALENDAR):
+    """カレンダーごとのストア（プロセス内で共有）"""
+    with _stores_lock:
+        store = _stores.get(calendar)
+        if store is None:
+            if EVENT_DB_PATH:
+                migrate_from = EVENT_FILE_PATH if calendar == DEFAULT_CALENDAR else None
+                store = SQLiteEventStore(EVENT_DB_PATH, migrate_from=migrate_from, calendar=calendar)
+            else:
+                store = EventStore(calendar_path(calendar))
+            _stores[calendar] = store
+        return store
 
 def load_events():
-    if os.path.exists(EVENT_FILE_PATH):
-        with open(EVENT_FILE_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+    return get_store().all()
 
 def save_events(events):
-    with open(EVENT_FILE_PATH, "w", encoding="utf-8") as f:
-        json.dump(events, f, ensure_ascii=False, indent=2)
+    get_store().replace_all(events)
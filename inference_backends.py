@@ -0,0 +1,167 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+LLMEventParser が使う推論エンジン
+
+setup.env の INFERENCE_BACKEND で選択する:
+- nf4         : bitsandbytes 4bit量子化（GPU向け、従来の動作）
+- cpu         : fp32 / bf16（INFERENCE_DTYPE）のCPU推論、torch.compile付き
+- cpu-int8    : Linear層を動的int8量子化したCPU推論
+- speculative : DRAFT_MODEL_PATH の小さいQwen3をドラフトに使う投機的デコーディング（SPECULATIVE_BASE のエンジン上で動作）
+- auto        : GPUがあれば nf4、なければ cpu
+"""
+
+import os
+from abc import ABC, abstractmethod
+
+
+class InferenceBackend(ABC):
+    """
+    Inference engine base class
+
+    `load` returns the tokenizer and model; `generate_kwargs` are merged into every `model.generate` call.
+    """
+    name = None
+    # 固定プレフィックスのKVキャッシュを generate に渡してよいか
+    supports_prefix_cache = True
+
+    @abstractmethod
+    def load(self, model_path):...
+
+    def generate_kwargs(self, batch_size: int) -> dict:
+        return {}
+
+    @staticmethod
+    def _load_tokenizer(model_path):
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+
+
+class NF4Backend(InferenceBackend):
+    """bitsandbytes NF4 quantization placed by `device_map` (no `.to()` on the quantized model)"""
+    name = "nf4"
+
+    def __init__(self, device=None):
+        self.device = device
+
+    def load(self, model_path):
+        import torch
+        from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+        model = AutoModelForCausalLM.from_pretrained(model_path,
+                                                     trust_remote_code=True,
+                                                     device_map=self.device or "auto",
+                                                     quantization_config=BitsAndBytesConfig(
+                                                        load_in_4bit=True,
+                                                        bnb_4bit_quant_type="nf4",
+                                                        bnb_4bit_use_double_quant=True,
+                                                        bnb_4bit_compute_dtype=torch.float16  # または bfloat16
+                                                    ))
+        return self._load_tokenizer(model_path), model.eval()
+
+
+class CPUBackend(InferenceBackend):
+    """Plain fp32 / bf16 weights on CPU, optionally with `torch.compile`"""
+    name = "cpu"
+
+    def __init__(self, dtype="bf16", compile: bool = True):
+        self.dtype = dtype
+        self.compile = compile
+
+    def load(self, model_path):
+        model = self._load_model(model_path)
+        if self.compile:
+            import torch
+            model.forward = torch.compile(model.forward, dynamic=True)
+        return self._load_tokenizer(model_path), model
+
+    def _load_model(self, model_path):
+        import torch
+        from transformers import AutoModelForCausalLM
+
+        torch_dtype = {"fp32": torch.float32, "bf16": torch.bfloat16}[self.dtype]
+        model = AutoModelForCausalLM.from_pretrained(model_path,
+                                                     trust_remote_code=True,
+                                                     torch_dtype=torch_dtype,
+                                                     device_map={"": "cpu"})
+        return model.eval()
+
+
+class CPUInt8Backend(CPUBackend):
+    """fp32 weights with `torch.nn.Linear` layers dynamically quantized to int8"""
+    name = "cpu-int8"
+
+    def __init__(self, compile: bool = False):
+        super().__init__(dtype="fp32", compile=compile)
+
+    def _load_model(self, model_path):
+        import torch
+        model = super()._load_model(model_path)
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class SpeculativeBackend(InferenceBackend):
+    """
+    Assisted generation with a small draft model
+
+    The target model is loaded by `base`; the draft model is loaded the same way and passed
+    as `assistant_model` (single-sequence generation only).
+    """
+    name = "speculative"
+    supports_prefix_cache = False
+
+    def __init__(self, draft_model_path, base: InferenceBackend):
+        self.draft_model_path = draft_model_path
+        self.base = base
+        self.draft_model = None
+
+    def load(self, model_path):
+        tokenizer, model = self.base.load(model_path)
+        _, self.draft_model = self.base.load(self.draft_model_path)
+        return tokenizer, model
+
+    def generate_kwargs(self, batch_size: int) -> dict:
+        if batch_size != 1:
+            return self.base.generate_kwargs(batch_size)
+        return {**self.base.generate_kwargs(batch_size), "assistant_model": self.draft_model}
+
+
+def get_backend(name=None, device=None) -> InferenceBackend:
+    """名前（省略時は環境変数 INFERENCE_BACKEND）から推論エンジンを作る"""
+    name = (name or os.getenv("INFERENCE_BACKEND") or "auto").strip().lower()
+    dtype = (os.getenv("INFERENCE_DTYPE") or "bf16").strip().lower()
+    compile = (os.getenv("INFERENCE_COMPILE") or "1").strip() == "1"
+
+    if name == "auto":
+        import torch
+        name = "nf4" if (device or ("cuda" if torch.cuda.is_available() else "cpu")) != "cpu" else "cpu"
+
+    if name == "nf4":
+        return NF4Backend(device=device)
+    if name == "cpu":
+        return CPUBackend(dtype=dtype, compile=compile)
+    if name == "cpu-int8":
+        return CPUInt8Backend()
+    if name == "speculative":
+        draft_model_path = os.getenv("DRAFT_MODEL_PATH")
+        if not draft_model_path:
+            raise ValueError("speculative には DRAFT_MODEL_PATH の設定が必要です")
+        if not os.path.isabs(draft_model_path):
+            draft_model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), draft_model_path)
+        base_name = (os.getenv("SPECULATIVE_BASE") or "auto").strip().lower()
+        if base_name == "speculative":
+            raise ValueError("SPECULATIVE_BASE に speculative は指定できません")
+        return SpeculativeBackend(draft_model_path, base=get_backend(base_name, device=device))
+    raise ValueError(f"未知の INFERENCE_BACKEND です: {name}")
@@ -0,0 +1,158 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+import recurrence
+# 正規形（"YYYY-MM-DDTHH:MM:SS"）の文字列は辞書順が時刻順なのでそのまま比較に使う
+from event_model import to_key as _key
+
+
+class IntervalIndex:
+    """
+    Sorted-array index over event start/end times
+
+    Events no longer than `long_threshold` are kept in one array sorted by start, so an overlap
+    query only looks at starts in [query_start - long_threshold, query_end): O(log N + k).
+    Longer events and recurring series (expanded per query) are few and are checked one by one.
+    Insertions are buffered and folded in on the next query (bulk loads are sorted once, a few
+    changes are inserted in place); removals delete the entry from the array directly.
+    """
+    def __init__(self, events=(), long_threshold=timedelta(days=1)):
+        self.long_threshold = long_threshold
+        # ID -> (開始キー, 終了キー, 終日か, 配列に入っているか)
+        self._entries = {}
+        self._starts = []
+        self._pending = []
+        self._long = set()
+        self._recurring = {}
+        for event in events:
+            self.put(event)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, event: dict):
+        """イベントを登録する（同じIDがあれば置き換える）"""
+        old = self._entries.get(event["id"])
+        if old is not None:
+            self._forget(event["id"], old)
+        self._add(event)
+
+    def load(self, events):
+        """登録済みの内容を捨てて events を登録し直す（読み込み時用、配列は次の検索で一度だけ並べ替える）"""
+        self.clear()
+        for event in events:
+            self._add(event)
+
+    def _add(self, event):
+        event_id = event["id"]
+        start = _key(event["start"])
+        end = _key(event.get("end") or event["start"])
+        short = False
+        if event.get("rrule"):
+            self._recurring[event_id] = {k: event.get(k) for k in ("id", "start", "end", "rrule", "exdate")}
+        elif (start[:10] != end[:10] or self.long_threshold < timedelta(days=1)) \
+                and datetime.fromisoformat(end) - datetime.fromisoformat(start) > self.long_threshold:
+            self._long.add(event_id)
+        else:
+            short = True
+        self._entries[event_id] = (start, end, bool(event.get("allDay", False)), short)
+        if short:
+            self._pending.append((start, event_id))
+
+    def remove(self, event_id):
+        entry = self._entries.pop(event_id, None)
+        if entry is not None:
+            self._forget(event_id, entry)
+
+    def clear(self):
+        self._entries.clear()
+        self._starts.clear()
+        self._pending.clear()
+        self._long.clear()
+        self._recurring.clear()
+
+    def overlapping(self, start, end, include_all_day: bool = True):
+        """
+        [start, end) と重なる (ID, 開始, 終了) を開始日時順に返す
+
+        繰り返し予定は重なる回ごとに返す
+        """
+        start, end = recurrence.to_datetime(start), recurrence.to_datetime(end)
+        start_key, end_key = start.isoformat(), end.isoformat()
+        self._flush()
+        found = []
+        lo = bisect_left(self._starts, ((start - self.long_threshold).isoformat(),))
+        hi = bisect_left(self._starts, (end_key,))
+        for s, event_id in self._starts[lo:hi]:
+            found.append((event_id, s, self._entries[event_id][1]))
+        for event_id in self._long:
+            s, e = self._entries[event_id][:2]
+            if s < end_key:
+                found.append((event_id, s, e))
+        for event_id, event in self._recurring.items():
+            for occurrence in recurrence.expand(event, start, end):
+                found.append((event_id, occurrence["start"], occurrence["end"]))
+
+        result = []
+        for event_id, s, e in found:
+            # 長さ0の予定は開始時刻が範囲内なら重なるとみなす
+            if s < end_key and (e > start_key or s >= start_key) and (include_all_day or not self._entries[event_id][2]):
+                result.append((event_id, datetime.fromisoformat(s), datetime.fromisoformat(e)))
+        return sorted(result, key=lambda r: r[1])
+
+    def free_slots(self, start, end, duration: timedelta, include_all_day: bool = False):
+        """[start, end) の中で duration 以上空いている区間 (開始, 終了) を順に返す（終日予定は既定で無視）"""
+        start, end = recurrence.to_datetime(start), recurrence.to_datetime(end)
+        cursor = start
+        for _, s, e in self.overlapping(start, end, include_all_day=include_all_day):
+            if s - cursor >= duration:
+                yield cursor, s
+            cursor = max(cursor, e)
+        if end - cursor >= duration:
+            yield cursor, end
+
+    def first_free_slot(self, start, end, duration: timedelta, include_all_day: bool = False):
+        """[start, end) で最初に duration だけ空いている (開始, 終了)（なければ None）"""
+        for slot_start, _ in self.free_slots(start, end, duration, include_all_day=include_all_day):
+            return slot_start, slot_start + duration
+        return None
+
+    def _forget(self, event_id, entry):
+        # 置き換え・削除の前に、古い位置を配列（または未反映の追加分）から外す
+        if not entry[3]:
+            self._long.discard(event_id)
+            self._recurring.pop(event_id, None)
+            return
+        item = (entry[0], event_id)
+        i = bisect_left(self._starts, item)
+        if i < len(self._starts) and self._starts[i] == item:
+            del self._starts[i]
+        else:
+            self._pending.remove(item)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        if len(self._pending) * 64 < len(self._starts):
+            # 少数の追加はその位置に入れる（配列全体は並べ替えない）
+            for item in self._pending:
+                insort(self._starts, item)
+        else:
+            # まとめて読み込んだ場合は一度に並べ替える
+            self._starts.extend(self._pending)
+            self._starts.sort()
+        self._pending.clear()
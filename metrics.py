@@ -0,0 +1,182 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+軽量な計測（カウンタ・処理時間のヒストグラム）と Prometheus テキスト形式での出力
+
+常時有効にしておける程度のコスト（1回の記録は perf_counter とロック程度）に抑えている。
+METRICS_ENABLED=0 で記録を止められる。
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "nlcalendar_"
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".datas", "metrics.prom")
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and latency histograms
+
+    Series are identified by name plus keyword labels.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._last_write = 0.0
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0, 0.0, [0] * (len(BUCKETS) + 1)]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2][i] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """with ブロックの処理時間を記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def stopwatch(self, name, **labels):
+        return Stopwatch(self, name, labels)
+
+    def render(self) -> str:
+        """Prometheus テキスト形式で出力する"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (v[0], v[1], list(v[2])) for k, v in self._histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for (n, labels), (count, total, buckets) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + ("+Inf",), buckets):
+                    cumulative += bucket
+                    lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=DEFAULT_PATH, min_interval: float = 0.0):
+        """
+        テキストファイルに書き出す（node_exporter の textfile collector 向け）
+
+        前回から min_interval 秒経っていなければ何もしない
+        """
+        now = time.monotonic()
+        if not self.enabled or now - self._last_write < min_interval:
+            return
+        self._last_write = now
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class Stopwatch:
+    """`lap(phase)` ごとに、前回の lap からの経過時間を phase ラベル付きで記録する"""
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.started = self._last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.metrics.observe(self.name, now - self._last, phase=phase, **self.labels)
+        self._last = now
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def start_http_server(port: int, host: str = "127.0.0.1", registry=None):
+    """GET /metrics で Prometheus 形式を返すHTTPサーバをデーモンスレッドで起動する"""
+    registry = registry or REGISTRY
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            data = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+REGISTRY = Metrics(enabled=os.getenv("METRICS_ENABLED", "1") != "0")
+
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+stopwatch = REGISTRY.stopwatch
+render = REGISTRY.render
+write = REGISTRY.write
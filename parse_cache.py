@@ -0,0 +1,144 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import metrics
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".datas", "parse_cache.sqlite3")
+
+
+def normalize_text(text: str) -> str:
+    """全角/半角や空白の揺れを吸収したキャッシュ用の正規化文字列を返す"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class ParseCache:
+    """
+    Two-level cache of parse results
+
+    An in-process LRU sits in front of an on-disk SQLite store.
+    Entries are keyed by normalized text, reference date, model identity and prompt version.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, memory_size: int = 512, disk_size: int = 50000):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        # ディスク上の件数（put 毎の COUNT(*) による全走査を避けるため起動時に一度だけ数える）
+        self._disk_count = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS parse_cache ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS parse_cache_accessed ON parse_cache(accessed)")
+            self._conn.commit()
+            self._disk_count = self._conn.execute("SELECT COUNT(*) FROM parse_cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(text: str, reference_date, model_id: str, prompt_version) -> str:
+        payload = json.dumps([normalize_text(text), str(reference_date), str(model_id), str(prompt_version)],
+                             ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """キャッシュされた解析結果を返す（なければ None）"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                metrics.inc("parse_cache_requests_total", result="hit", level="memory")
+                return dict(self._memory[key])
+
+            if self._conn is not None:
+                row = self._conn.execute("SELECT value FROM parse_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE parse_cache SET accessed = ? WHERE key = ?", (time.time(), key))
+                    self._conn.commit()
+                    value = json.loads(row[0])
+                    self._put_memory(key, value)
+                    self.hits += 1
+                    metrics.inc("parse_cache_requests_total", result="hit", level="disk")
+                    return dict(value)
+
+            self.misses += 1
+            metrics.inc("parse_cache_requests_total", result="miss", level="disk" if self._conn is not None else "memory")
+            return None
+
+    def put(self, key: str, value: dict):
+        with self._lock:
+            self._put_memory(key, value)
+            if self._conn is not None:
+                exists = self._conn.execute("SELECT 1 FROM parse_cache WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO parse_cache (key, value, accessed) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), time.time())
+                )
+                if exists is None:
+                    self._disk_count += 1
+                    self._evict_disk()
+                self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM parse_cache")
+                self._conn.commit()
+                self._disk_count = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+        }
+
+    def _put_memory(self, key, value):
+        self._memory[key] = dict(value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        overflow = self._disk_count - self.disk_size
+        if overflow > 0:
+            # 最終アクセスが古いものから削除
+            cur = self._conn.execute(
+                "DELETE FROM parse_cache WHERE key IN ("
+                " SELECT key FROM parse_cache ORDER BY accessed ASC LIMIT ?)",
+                (overflow,)
+            )
+            self._disk_count -= cur.rowcount
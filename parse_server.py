@@ -0,0 +1,305 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+LLMEventParser を共有する非同期解析サーバとそのクライアント
+
+複数セッションからのリクエストをキューで受け付け、遅延予算（max_wait_ms）の範囲で
+マイクロバッチにまとめて `parse_many` で処理する。
+
+    python parse_server.py --port 8765
+    python parse_server.py --unix /tmp/nlcalendar.sock
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import socket
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import event_model
+import metrics
+from NLParser import BaseParser
+
+
+class ParserUnavailable(Exception):
+    """Raised for requests that cannot be served because the parser failed to load"""
+
+
+class ParseServer:
+    """
+    Asyncio HTTP front-end with dynamic micro-batching
+
+    Requests are queued (bounded by `queue_size`; a full queue answers 503) and a single batcher task
+    drains up to `batch_size` of them, waiting at most `max_wait_ms` for a batch to fill.
+    Each request is answered with 504 if it is not done within `request_timeout` seconds.
+    If the parser fails to load, the error is kept in `load_error` and every request is answered with 503.
+    """
+    def __init__(self, parser_factory, batch_size: int = 8, max_wait_ms: float = 20,
+                 queue_size: int = 256, request_timeout: float = 30):
+        self.parser_factory = parser_factory
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.request_timeout = request_timeout
+
+        self.parser = None
+        self.load_error = None
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        # 生成は1スレッドで直列に行う（モデルは1つなので並列化しても速くならない）
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="parse-worker")
+
+    async def serve(self, host="127.0.0.1", port=8765, unix_socket=None):
+        if unix_socket:
+            server = await asyncio.start_unix_server(self._handle, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self._handle, host=host, port=port)
+        batcher = asyncio.create_task(self._batch_loop())
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                batcher.cancel()
+
+    async def submit(self, text: str):
+        """1件の入力をキューに積み、解析結果を待つ"""
+        if self.load_error is not None:
+            raise ParserUnavailable(self.load_error)
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))  # 満杯なら asyncio.QueueFull
+        with metrics.timer("server_request_seconds"):
+            return await asyncio.wait_for(future, self.request_timeout)
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self.parser = await loop.run_in_executor(self._executor, self.parser_factory)
+        except Exception as e:
+            # 読み込めなければ、待っているリクエストと以後のリクエストにはすぐ 503 を返す
+            self.load_error = f"{type(e).__name__}: {e}"
+            print("failed to load the parser:", file=sys.stderr)
+            traceback.print_exc()
+            while True:
+                _, future = await self._queue.get()
+                if not future.done():
+                    future.set_exception(ParserUnavailable(self.load_error))
+
+        while True:
+            try:
+                await self._run_batch(loop)
+            except Exception:
+                # 想定外のエラーでもバッチ処理を止めない（そのバッチのリクエストは _run_batch で失敗させる）
+                print("parse batch failed:", file=sys.stderr)
+                traceback.print_exc()
+
+    async def _run_batch(self, loop):
+        """キューから1バッチ分を取り出して解析し、各リクエストに結果を返す"""
+        batch = [await self._queue.get()]
+        try:
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # タイムアウト済みのリクエストは生成しない
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                return
+
+            texts = [text for text, _ in batch]
+            metrics.inc("server_batches_total")
+            metrics.inc("server_batch_items_total", len(texts))
+            try:
+                results = await loop.run_in_executor(self._executor, self._parse_batch, texts)
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+    def _parse_batch(self, texts):
+        # 長時間動かしても「今日」がずれないように基準時刻を更新する
+        self.parser.reference_time = event_model.now()
+        return self.parser.parse_many(texts, batch_size=self.batch_size)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            status, payload = await self._route(method, path, body)
+        except Exception as e:
+            status, payload = 400, {"error": str(e)}
+
+        if isinstance(payload, str):
+            data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            data, content_type = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+        writer.write(
+            f"HTTP/1.1 {status} {http.client.responses.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + data
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            if self.load_error is not None:
+                return 503, {"ready": False, "error": self.load_error, "queued": self._queue.qsize()}
+            return 200, {"ready": self.parser is not None, "queued": self._queue.qsize()}
+        if method == "GET" and path == "/metrics":
+            return 200, metrics.render()
+        if method != "POST":
+            return 404, {"error": f"unknown endpoint: {method} {path}"}
+
+        request = json.loads(body or b"{}")
+        if path == "/parse":
+            return await self._answer(request["text"])
+        if path == "/parse_many":
+            answers = await asyncio.gather(*(self._answer(t) for t in request["texts"]))
+            return 200, {"results": [payload for _, payload in answers]}
+        return 404, {"error": f"unknown endpoint: {method} {path}"}
+
+    async def _answer(self, text):
+        try:
+            return 200, {"result": await self.submit(text)}
+        except asyncio.QueueFull:
+            metrics.inc("server_rejected_total", reason="queue_full")
+            return 503, {"error": "解析キューが満杯です"}
+        except ParserUnavailable as e:
+            metrics.inc("server_rejected_total", reason="unavailable")
+            return 503, {"error": f"言語モデルを読み込めませんでした: {e}"}
+        except asyncio.TimeoutError:
+            metrics.inc("server_rejected_total", reason="timeout")
+            return 504, {"error": "解析がタイムアウトしました"}
+        except Exception as e:
+            return 422, {"error": str(e)}
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class RemoteEventParser(BaseParser):
+    """
+    Thin client for `ParseServer`
+
+    Drop-in replacement for `LLMEventParser` (`parse` / `parse_many`) that forwards requests
+    to a parse server at `url` ("http://host:port" or "unix:///path/to.sock").
+    """
+    def __init__(self, url="http://127.0.0.1:8765", timeout: float = 60, reference_time=None, **kwargs):
+        super().__init__(reference_time=reference_time or event_model.now(), **kwargs)
+        self.url = urlparse(url)
+        self.timeout = timeout
+
+    def parse(self, text: str):
+        status, payload = self._request("POST", "/parse", {"text": text})
+        if status != 200:
+            raise ValueError(f"解析サーバでエラーが発生しました ({status}): {payload.get('error')}")
+        return payload["result"]
+
+    def parse_many(self, texts, batch_size: int = 8):
+        """`LLMEventParser.parse_many` と同じく、失敗した要素には ValueError が入る"""
+        texts = list(texts)
+        if not texts:
+            return []
+        status, payload = self._request("POST", "/parse_many", {"texts": texts})
+        if status != 200:
+            return [ValueError(f"解析サーバでエラーが発生しました ({status}): {payload.get('error')}")] * len(texts)
+        return [r["result"] if "result" in r else ValueError(r["error"]) for r in payload["results"]]
+
+    def ready(self) -> bool:
+        try:
+            status, payload = self._request("GET", "/health")
+        except OSError:
+            return False
+        return status == 200 and payload.get("ready", False)
+
+    def _request(self, method, path, body=None):
+        if self.url.scheme == "unix":
+            conn = _UnixHTTPConnection(self.url.path, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+        try:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else None
+            conn.request(method, path, body=data, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read() or b"{}")
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="NL Calendar parse server")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--unix", default=None, help="listen on a Unix socket instead of TCP")
+    arg_parser.add_argument("--batch-size", type=int, default=8)
+    arg_parser.add_argument("--max-wait-ms", type=float, default=20)
+    arg_parser.add_argument("--queue-size", type=int, default=256)
+    arg_parser.add_argument("--timeout", type=float, default=30)
+    arg_parser.add_argument("--constrained", action="store_true", help="use schema-constrained decoding")
+    args = arg_parser.parse_args()
+
+    def build_parser():
+        from NLParser import LLMEventParser
+        from parse_cache import ParseCache
+        started = time.perf_counter()
+        parser = LLMEventParser(cache=ParseCache(), constrained=args.constrained)
+        parser.warmup()
+        print(f"model loaded in {time.perf_counter() - started:.1f}s")
+        return parser
+
+    server = ParseServer(build_parser, batch_size=args.batch_size, max_wait_ms=args.max_wait_ms,
+                         queue_size=args.queue_size, request_timeout=args.timeout)
+    asyncio.run(server.serve(host=args.host, port=args.port, unix_socket=args.unix))
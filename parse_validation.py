@@ -0,0 +1,139 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+解析結果の検査（スキーマと基準日時に対する妥当性）と、再試行に使う計算量の上限・多数決
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import recurrence
+
+ACTIONS = ("add", "modify", "delete")
+REQUIRED_KEYS = ("action", "title", "start", "end", "all_day", "original_title", "original_start")
+
+# 問題ごとの減点（確信度は 1.0 から引く）
+_PENALTIES = {
+    "empty_title": 0.5,
+    "end_before_start": 0.6,
+    "zero_length": 0.2,
+    "too_long": 0.3,
+    "year_out_of_range": 0.6,
+    "in_past": 0.3,
+    "invalid_rrule": 0.4,
+    "all_day_not_midnight": 0.2,
+}
+
+
+def validate(result, reference_time: datetime):
+    """
+    解析結果の辞書を検査して (確信度 0.0～1.0, 問題の名前のリスト) を返す
+
+    形式が壊れている（キーや action がない、日時として読めない）場合は確信度 0.0
+    """
+    if not isinstance(result, dict):
+        return 0.0, ["not_object"]
+    if any(k not in result for k in REQUIRED_KEYS):
+        return 0.0, ["missing_keys"]
+    if result["action"] not in ACTIONS:
+        return 0.0, ["invalid_action"]
+    # null や数値の日時は変換できないので、形式の壊れた結果として扱う
+    if not all(isinstance(result[k], str) for k in ("start", "end", "original_start")):
+        return 0.0, ["invalid_datetime"]
+    try:
+        start = recurrence.to_datetime(result["start"])
+        end = recurrence.to_datetime(result["end"])
+        recurrence.to_datetime(result["original_start"])
+    except (TypeError, ValueError):
+        return 0.0, ["invalid_datetime"]
+    # タイムゾーン付きの基準日時も、解析結果と同じくカレンダーのタイムゾーンの時刻で比べる
+    reference_time = recurrence.to_datetime(reference_time)
+
+    problems = []
+    if not str(result["title"]).strip():
+        problems.append("empty_title")
+    if end < start:
+        problems.append("end_before_start")
+    elif end == start:
+        problems.append("zero_length")
+    elif not result["all_day"] and end - start > timedelta(days=1):
+        problems.append("too_long")
+    # 「明日」「来週」の解釈で年を取り違えたもの（年末年始をまたぐ分は許す）
+    if not reference_time.year - 1 <= start.year <= reference_time.year + 1:
+        problems.append("year_out_of_range")
+    elif result["action"] == "add" and start < reference_time - timedelta(days=31):
+        problems.append("in_past")
+    if result.get("rrule"):
+        try:
+            recurrence.parse_rrule(result["rrule"])
+        except ValueError:
+            problems.append("invalid_rrule")
+    if result["all_day"] and (start.hour, start.minute) != (0, 0):
+        problems.append("all_day_not_midnight")
+
+    confidence = 1.0 - sum(_PENALTIES[p] for p in problems)
+    return max(0.0, min(1.0, confidence)), problems
+
+
+def vote(candidates):
+    """
+    (解析結果, 確信度) の候補から多数決で1つ選び、(解析結果, 確信度) を返す
+
+    内容が同じ候補の確信度を合計し、最も大きいグループの中で確信度が最も高いものを返す。
+    確信度は「そのグループの確信度の合計 / 全候補数」（候補がなければ (None, 0.0)）
+    """
+    groups = {}
+    for result, confidence in candidates:
+        if result is None or confidence <= 0:
+            continue
+        groups.setdefault(_vote_key(result), []).append((result, confidence))
+    if not groups:
+        return None, 0.0
+    best = max(groups.values(), key=lambda g: sum(c for _, c in g))
+    result, _ = max(best, key=lambda rc: rc[1])
+    return result, sum(c for _, c in best) / len(candidates)
+
+
+def _vote_key(result):
+    def minute(value):
+        return str(value)[:16]
+    return (result.get("action"), str(result.get("title", "")).strip(), minute(result.get("start")),
+            minute(result.get("end")), bool(result.get("all_day")), result.get("rrule") or "")
+
+
+class ComputeBudget:
+    """
+    Per-request budget of generated tokens and wall-clock seconds
+
+    `spend` records tokens used by an attempt; `remaining_*` tell the scheduler whether another one fits.
+    """
+    def __init__(self, max_tokens: int = 512, max_seconds: float = 10.0):
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.used_tokens = 0
+        self._started = time.perf_counter()
+
+    def spend(self, tokens: int):
+        self.used_tokens += tokens
+
+    def remaining_tokens(self) -> int:
+        return max(0, self.max_tokens - self.used_tokens)
+
+    def remaining_seconds(self) -> float:
+        return max(0.0, self.max_seconds - (time.perf_counter() - self._started))
+
+    def allows(self, tokens: int) -> bool:
+        """tokens を使う試行がまだ収まるか"""
+        return self.remaining_tokens() >= tokens and self.remaining_seconds() > 0
@@ -0,0 +1,319 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+繰り返し予定の規則（RRULE）と、表示範囲に限った発生日時の遅延展開
+
+繰り返し予定は "rrule" キーを持つ1件のイベントとして保存し、各回の予定は
+表示する範囲についてだけジェネレータで作る。
+
+対応する RRULE（RFC 5545）のサブセット:
+FREQ=DAILY/WEEKLY/MONTHLY/YEARLY, INTERVAL, COUNT, UNTIL, BYDAY（WEEKLY）, BYMONTHDAY（MONTHLY）
+削除した回は "exdate" キー（各回の開始日時のリスト、ICS の EXDATE）に入れて展開時に除く。
+"""
+
+import calendar
+import json
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import count
+
+import event_model
+
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+FREQS = ("DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+# 終わりのない繰り返しの終了日時（保存時の索引用）
+FOREVER = "9999-12-31T23:59:59"
+# 発生のない周期がこれだけ続いたら打ち切る（例: 2月始まりで12か月ごとの31日）
+_MAX_EMPTY_PERIODS = 1000
+
+RecurrenceRule = namedtuple("RecurrenceRule", "freq interval count until byday bymonthday")
+
+
+@lru_cache(maxsize=1024)
+def parse_rrule(rule: str) -> RecurrenceRule:
+    """"FREQ=WEEKLY;BYDAY=MO" 形式の文字列を解析する（不正なら ValueError）"""
+    text = rule.strip()
+    if text.upper().startswith("RRULE:"):
+        text = text[6:]
+    parts = {}
+    for item in text.split(";"):
+        if not item.strip():
+            continue
+        name, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"RRULE の形式が不正です: {rule}")
+        parts[name.strip().upper()] = value.strip().upper()
+
+    freq = parts.get("FREQ")
+    if freq not in FREQS:
+        raise ValueError(f"未対応の FREQ です: {rule}")
+    interval = int(parts.get("INTERVAL", 1))
+    if interval < 1:
+        raise ValueError(f"INTERVAL は1以上にしてください: {rule}")
+    count_ = int(parts["COUNT"]) if "COUNT" in parts else None
+    until = _parse_until(parts["UNTIL"]) if "UNTIL" in parts else None
+
+    byday = None
+    if "BYDAY" in parts:
+        try:
+            byday = tuple(sorted({WEEKDAYS.index(d.strip()) for d in parts["BYDAY"].split(",")}))
+        except ValueError:
+            raise ValueError(f"BYDAY の曜日が不正です: {rule}")
+    bymonthday = None
+    if "BYMONTHDAY" in parts:
+        bymonthday = tuple(sorted({int(d) for d in parts["BYMONTHDAY"].split(",")}))
+        if any(d == 0 or not -31 <= d <= 31 for d in bymonthday):
+            raise ValueError(f"BYMONTHDAY が不正です: {rule}")
+    return RecurrenceRule(freq, interval, count_, until, byday, bymonthday)
+
+
+def format_rrule(freq: str, interval: int = 1, byday=(), bymonthday=(), count=None, until=None) -> str:
+    parts = [f"FREQ={freq}"]
+    if interval != 1:
+        parts.append(f"INTERVAL={interval}")
+    if byday:
+        parts.append("BYDAY=" + ",".join(WEEKDAYS[d] for d in byday))
+    if bymonthday:
+        parts.append("BYMONTHDAY=" + ",".join(str(d) for d in bymonthday))
+    if count is not None:
+        parts.append(f"COUNT={count}")
+    if until is not None:
+        parts.append("UNTIL=" + until.strftime("%Y%m%dT%H%M%S"))
+    return ";".join(parts)
+
+
+def iter_starts(rule: RecurrenceRule, dtstart: datetime, not_before=None):
+    """
+    dtstart から始まる各回の開始日時を昇順に生成する（COUNT / UNTIL がなければ無限）
+
+    COUNT がない場合は not_before より前の周期を計算で読み飛ばす
+    """
+    skip_to = not_before if rule.count is None and not_before is not None and not_before > dtstart else None
+    n = 0
+    for start in _candidates(rule, dtstart, skip_to):
+        if rule.until is not None and start > rule.until:
+            return
+        if rule.count is not None and n >= rule.count:
+            return
+        n += 1
+        yield start
+
+
+def expand(event: dict, start, end):
+    """繰り返し予定 event の各回のうち [start, end) と重なるものを、日時を置き換えた辞書として生成する"""
+    rule = parse_rrule(event["rrule"])
+    dtstart = to_datetime(event["start"])
+    duration = to_datetime(event.get("end") or event["start"]) - dtstart
+    window_start, window_end = to_datetime(start), to_datetime(end)
+    excluded = set(event.get("exdate") or ())
+
+    for occurrence in iter_starts(rule, dtstart, not_before=window_start - duration):
+        if occurrence >= window_end:
+            return
+        if excluded and occurrence.isoformat() in excluded:
+            continue
+        occurrence_end = occurrence + duration
+        # 範囲の開始ちょうどに終わる回は含めない（長さ0の回は開始が範囲内なら含める）
+        if occurrence_end <= window_start and occurrence < window_start:
+            continue
+        yield {**event,
+               "start": occurrence.isoformat(),
+               "end": occurrence_end.isoformat(),
+               # 同じ繰り返しの各回をカレンダー上でまとめて扱うため
+               "groupId": event["id"],
+               "seriesStart": event["start"]}
+
+
+def apply_to_series(series: dict, occurrence_start, updated: dict) -> dict:
+    """
+    繰り返し予定 series の1回（occurrence_start の日の回）への変更 updated を、系列全体の変更にして返す
+
+    系列の開始日は変えず、時刻・長さ（とタイトルなどのほかの項目）だけを反映する。
+    回ごとの例外には未対応なので、最初の回以外の日付を変える変更は ValueError
+    """
+    occurrence_day = to_datetime(occurrence_start).date()
+    series_start = to_datetime(series["start"])
+    start = to_datetime(updated["start"])
+    end = to_datetime(updated.get("end") or updated["start"])
+    if occurrence_day == series_start.date():
+        # 最初の回の変更は系列の開始日時の変更として扱う
+        new_start = start
+    elif start.date() != occurrence_day:
+        raise ValueError("繰り返し予定の1回だけの日付の変更には対応していません（系列の開始日は最初の回で変更してください）")
+    else:
+        new_start = datetime.combine(series_start.date(), start.time())
+    return {**updated,
+            "start": new_start.isoformat(),
+            "end": (new_start + (end - start)).isoformat()}
+
+
+def occurrence_on(event: dict, day):
+    """繰り返し予定 event の day（日時なら日付部分）に始まる回の開始日時（なければ None）"""
+    day_start = datetime.combine(to_datetime(day).date(), datetime.min.time())
+    for occurrence in expand(event, day_start, day_start + timedelta(days=1)):
+        if occurrence["start"][:10] == day_start.date().isoformat():
+            return occurrence["start"]
+    return None
+
+
+def exclude_occurrence(event: dict, occurrence_start) -> dict:
+    """繰り返し予定 event から occurrence_start の回を除いた（EXDATE を加えた）新しい辞書を返す"""
+    excluded = set(event.get("exdate") or ()) | {to_datetime(occurrence_start).isoformat()}
+    return {**event, "exdate": sorted(excluded)}
+
+
+def has_occurrences(event: dict) -> bool:
+    """除外されていない回が1つでも残っているか"""
+    excluded = set(event.get("exdate") or ())
+    rule = parse_rrule(event["rrule"])
+    return any(s.isoformat() not in excluded for s in iter_starts(rule, to_datetime(event["start"])))
+
+
+def series_end(event: dict) -> str:
+    """繰り返し予定の最後の回の終了日時（終わりがなければ FOREVER）"""
+    rule = parse_rrule(event["rrule"])
+    dtstart = to_datetime(event["start"])
+    duration = to_datetime(event.get("end") or event["start"]) - dtstart
+    if rule.count is not None:
+        last = dtstart
+        for last in iter_starts(rule, dtstart):
+            pass
+        return (last + duration).isoformat()
+    if rule.until is not None:
+        return (rule.until + duration).isoformat()
+    return FOREVER
+
+
+class ExpansionCache:
+    """
+    LRU cache of expanded occurrences
+
+    Keyed by the series content and the window, so edits to a series never hit stale entries.
+    """
+    def __init__(self, size: int = 256):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def expand(self, event: dict, start, end):
+        key = (json.dumps(event, ensure_ascii=False, sort_keys=True), str(start), str(end))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return [dict(e) for e in self._entries[key]]
+        occurrences = list(expand(event, start, end))
+        with self._lock:
+            self._entries[key] = occurrences
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return [dict(e) for e in occurrences]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = ExpansionCache()
+
+
+def expand_events(events, start, end):
+    """events のうち繰り返し予定を [start, end) の各回に展開し、開始日時順に並べて返す"""
+    expanded = []
+    for event in events:
+        if event.get("rrule"):
+            expanded.extend(_cache.expand(event, start, end))
+        else:
+            expanded.append(event)
+    expanded.sort(key=lambda e: to_datetime(e["start"]))
+    return expanded
+
+
+def _candidates(rule, dtstart, skip_to):
+    if rule.freq == "DAILY":
+        first = 0 if skip_to is None else max(0, (skip_to - dtstart).days // rule.interval - 1)
+        for k in count(first):
+            yield dtstart + timedelta(days=k * rule.interval)
+
+    elif rule.freq == "WEEKLY":
+        weekdays = rule.byday or (dtstart.weekday(),)
+        week0 = dtstart - timedelta(days=dtstart.weekday())
+        first = 0 if skip_to is None else max(0, (skip_to - week0).days // 7 // rule.interval - 1)
+        for w in count(first):
+            base = week0 + timedelta(weeks=w * rule.interval)
+            for d in weekdays:
+                start = base + timedelta(days=d)
+                if start >= dtstart:
+                    yield start
+
+    elif rule.freq == "MONTHLY":
+        days = rule.bymonthday or (dtstart.day,)
+        months0 = dtstart.year * 12 + dtstart.month - 1
+        first = 0
+        if skip_to is not None:
+            first = max(0, (skip_to.year * 12 + skip_to.month - 1 - months0) // rule.interval - 1)
+        empty = 0
+        for m in count(first):
+            year, month = divmod(months0 + m * rule.interval, 12)
+            month += 1
+            if year > 9999:
+                return
+            last_day = calendar.monthrange(year, month)[1]
+            found = False
+            for day in sorted(d if d > 0 else last_day + 1 + d for d in days):
+                if 1 <= day <= last_day:
+                    start = dtstart.replace(year=year, month=month, day=day)
+                    if start >= dtstart:
+                        found = True
+                        yield start
+            empty = 0 if found else empty + 1
+            if empty >= _MAX_EMPTY_PERIODS:
+                return
+
+    elif rule.freq == "YEARLY":
+        first = 0 if skip_to is None else max(0, (skip_to.year - dtstart.year) // rule.interval - 1)
+        empty = 0
+        for k in count(first):
+            year = dtstart.year + k * rule.interval
+            if year > 9999:
+                return
+            try:
+                # 2月29日始まりはうるう年だけ
+                yield dtstart.replace(year=year)
+                empty = 0
+            except ValueError:
+                empty += 1
+                if empty >= _MAX_EMPTY_PERIODS:
+                    return
+
+
+def _parse_until(value: str) -> datetime:
+    for fmt in ("%Y%m%dT%H%M%S", "%Y%m%d"):
+        try:
+            until = datetime.strptime(value.rstrip("Z"), fmt)
+        except ValueError:
+            continue
+        if value.endswith("Z"):
+            # UTC の指定はカレンダーのタイムゾーンの時刻にする
+            return to_datetime(until.replace(tzinfo=timezone.utc))
+        # 日付だけの場合はその日の終わりまで
+        return until if "T" in fmt else until + timedelta(days=1, seconds=-1)
+    return to_datetime(value)
+
+
+def to_datetime(value) -> datetime:
+    """datetime / ISO文字列を、カレンダーのタイムゾーンでの秒単位の時刻（tzinfoなし）に揃える"""
+    return event_model.to_local(value)
@@ -0,0 +1,36 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from event_index import EventIndex
+
+EVENTS = [{"id": "room", "title": "会議室の予約", "start": "2025-06-19T15:00:00"},
+          {"id": "series", "title": "定例", "start": "2025-06-05T10:00:00", "end": "2025-06-05T11:00:00",
+           "rrule": "FREQ=WEEKLY"}]
+
+
+def test_fuzzy_find_matches_within_the_day():
+    assert EventIndex(EVENTS).find("会議", "2025-06-19T10:00:00") == ["room"]
+
+
+def test_strict_find_requires_the_same_minute():
+    index = EventIndex(EVENTS)
+    assert index.find("会議", "2025-06-19T10:00:00", strict=True) == []
+    assert index.find("会議室予約", "2025-06-19T15:00:00", strict=True) == ["room"]
+    assert index.find("定例会", "2025-06-19T10:00:00", strict=True) == ["series"]
+
+
+def test_strict_find_by_date_requires_the_same_title():
+    index = EventIndex(EVENTS)
+    assert index.find("会議", "2025-06-19", strict=True) == []
+    assert index.find("会議室の予約", "2025-06-19", strict=True) == ["room"]
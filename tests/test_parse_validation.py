@@ -0,0 +1,37 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+
+import pytest
+
+from parse_validation import validate
+
+REFERENCE = datetime(2025, 6, 1, 9, 0)
+
+
+def _result(**overrides):
+    result = {"action": "add", "title": "会議", "start": "2025-06-02T10:00:00", "end": "2025-06-02T11:00:00",
+              "all_day": False, "original_title": "会議", "original_start": "2025-06-02T10:00:00"}
+    result.update(overrides)
+    return result
+
+
+def test_valid_result():
+    assert validate(_result(), REFERENCE) == (1.0, [])
+
+
+@pytest.mark.parametrize("overrides", [{"start": None}, {"end": 123}, {"original_start": None}])
+def test_non_string_datetime_is_invalid(overrides):
+    assert validate(_result(**overrides), REFERENCE) == (0.0, ["invalid_datetime"])
@@ -0,0 +1,52 @@
+# Copyright 2025 KSkya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import recurrence
+from event_storage import EventStore, SQLiteEventStore, delete_occurrence
+
+SERIES = {"title": "定例", "start": "2025-06-02T10:00:00", "end": "2025-06-02T11:00:00", "rrule": "FREQ=WEEKLY;COUNT=4"}
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "json":
+        return EventStore(str(tmp_path / "events.json"))
+    return SQLiteEventStore(str(tmp_path / "events.db"), migrate_from=None)
+
+
+def _starts(store):
+    return [e["start"] for e in store.query_range("2025-06-01T00:00:00", "2025-07-01T00:00:00")]
+
+
+def test_delete_one_occurrence_keeps_the_others(store):
+    series_id = store.add(dict(SERIES))
+    series = store.get(series_id)
+    occurrence = recurrence.occurrence_on(series, "2025-06-16")
+    assert occurrence == "2025-06-16T10:00:00"
+
+    delete_occurrence(store, series, occurrence, expected_version=series["version"])
+    assert _starts(store) == ["2025-06-02T10:00:00", "2025-06-09T10:00:00", "2025-06-23T10:00:00"]
+    # 索引も除いた回を返さない
+    assert [e["id"] for e in store.find("定例", "2025-06-09T10:00:00")] == [series_id]
+    assert store.conflicts({"start": "2025-06-16T10:00:00", "end": "2025-06-16T11:00:00"}) == []
+
+
+def test_delete_last_occurrence_deletes_the_series(store):
+    series_id = store.add({**SERIES, "rrule": "FREQ=WEEKLY;COUNT=2"})
+    for day in ("2025-06-02", "2025-06-09"):
+        series = store.get(series_id)
+        delete_occurrence(store, series, recurrence.occurrence_on(series, day))
+    assert store.get(series_id) is None